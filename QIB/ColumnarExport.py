@@ -0,0 +1,145 @@
+"""
+Name: ColumnarExport
+Function: Writes the subject x concept matrix and the metadata tags as typed columnar files (Parquet or Arrow IPC) next
+to the TranSMART text layout, for loading into analytics tooling.
+Company: The Hyve
+
+The observations are written in long format, one row per retrieved value, with the parts of the concept path as
+separate dictionary encoded columns. Both files are built from the data in memory during the same run.
+
+Requirements:
+pyarrow     Only needed when the [Columnar] section is present in the params configuration.
+"""
+
+import logging
+import os
+
+import numpy
+
+CONCEPT_PATH_FIELDS = ['tool', 'scanner', 'category', 'laterality', 'timepoint', 'biomarker']
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+class TagRecorder(object):
+    """
+    Passes everything written to the tag file on to it and keeps the tag lines, so they can be exported again
+    without reading tags.txt back.
+    """
+
+    def __init__(self, tag_file):
+        self.tag_file = tag_file
+        self.lines = []
+
+    def write(self, text):
+        self.tag_file.write(text)
+        self.lines.extend(text.splitlines())
+
+    def __getattr__(self, name):
+        return getattr(self.tag_file, name)
+
+
+def dictionary_array(pyarrow, indices, dictionary):
+    """
+    Function: Creates a dictionary encoded string column.
+    Parameters:
+        -pyarrow        Module          The pyarrow module.
+        -indices        numpy.ndarray   Index in dictionary for every row.
+        -dictionary     List            Distinct values of the column.
+    Returns:
+        -array          pyarrow.DictionaryArray
+    """
+    return pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, type=pyarrow.int32()),
+                                               pyarrow.array(dictionary, type=pyarrow.string()))
+
+
+def observation_table(pyarrow, concept_matrix):
+    """
+    Function: Converts the concept matrix to a table with a row per retrieved value.
+    Parameters:
+        -pyarrow            Module          The pyarrow module.
+        -concept_matrix     ConceptMatrix   Subject x concept matrix with all the retrieved values.
+    Returns:
+        -table              pyarrow.Table   Columns subject, the concept path fields, value and raw_value.
+    """
+    row_ids = []
+    concept_ids = []
+    numbers = []
+    raw_values = []
+    for concept_id in range(len(concept_matrix.columns)):
+        present, column_numbers = concept_matrix.sparse_column(concept_id)
+        row_ids.append(present)
+        concept_ids.append(numpy.full(len(present), concept_id, dtype=numpy.int32))
+        numbers.append(column_numbers)
+        raw_values.extend(text for row, number, text in concept_matrix.column_values(concept_id))
+    row_ids = numpy.concatenate(row_ids) if row_ids else numpy.zeros(0, dtype=numpy.int32)
+    concept_ids = numpy.concatenate(concept_ids) if concept_ids else numpy.zeros(0, dtype=numpy.int32)
+    numbers = numpy.concatenate(numbers) if numbers else numpy.zeros(0)
+
+    columns = {'subject': dictionary_array(pyarrow, row_ids, concept_matrix.subjects)}
+    path_items = [concept_key.split('\\') for concept_key in concept_matrix.columns]
+    for position, field in enumerate(CONCEPT_PATH_FIELDS):
+        # Concept paths with fewer parts than expected keep their last part as the biomarker.
+        if field == 'biomarker':
+            values = [items[-1] for items in path_items]
+        else:
+            values = [items[position] if len(items) == len(CONCEPT_PATH_FIELDS) else None for items in path_items]
+        dictionary = sorted(set(value for value in values if value is not None))
+        lookup = dict((value, index) for index, value in enumerate(dictionary))
+        column_indices = numpy.array([lookup.get(value, -1) for value in values], dtype=numpy.int32)
+        indices = column_indices[concept_ids] if len(column_indices) else numpy.zeros(0, dtype=numpy.int32)
+        columns[field] = pyarrow.DictionaryArray.from_arrays(
+            pyarrow.array(indices, type=pyarrow.int32(), mask=indices < 0),
+            pyarrow.array(dictionary, type=pyarrow.string()))
+    columns['value'] = pyarrow.array(numbers, type=pyarrow.float64(), from_pandas=True)
+    columns['raw_value'] = pyarrow.array(raw_values, type=pyarrow.string())
+    return pyarrow.table(columns)
+
+
+def tag_table(pyarrow, tag_lines):
+    """
+    Function: Converts the tag lines to a table.
+    Parameters:
+        -pyarrow        Module          The pyarrow module.
+        -tag_lines      List            Tag lines as written to tags.txt, without the header.
+    Returns:
+        -table          pyarrow.Table   Columns concept_path, title, description and weight.
+    """
+    fields = [line.split('\t') for line in tag_lines if line]
+    return pyarrow.table({
+        'concept_path': pyarrow.array([x[0] for x in fields], type=pyarrow.string()),
+        'title': pyarrow.array([x[1] for x in fields], type=pyarrow.string()),
+        'description': pyarrow.array([x[2] for x in fields], type=pyarrow.string()),
+        'weight': pyarrow.array([int(x[3]) for x in fields], type=pyarrow.int32()),
+    })
+
+
+def write_columnar(path, concept_matrix, tag_lines, config):
+    """
+    Function: Writes <STUDY_ID>_observations and <STUDY_ID>_tags to the columnar directory of the export.
+    Parameters:
+        -path               String                  Path to the directory where all the files will be saved.
+        -concept_matrix     ConceptMatrix           Subject x concept matrix with all the retrieved values.
+        -tag_lines          List                    Tag lines as written to tags.txt, without the header.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+    Returns:
+        -written            Boolean                 False if pyarrow is not installed.
+    """
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        print("pyarrow not installed, columnar export skipped")
+        logging.error("pyarrow not installed, columnar export skipped.")
+        return False
+
+    os.makedirs(path + '/columnar/', exist_ok=True)
+    extension = EXTENSIONS[config.columnar_format]
+    tables = [('_observations', observation_table(pyarrow, concept_matrix)), ('_tags', tag_table(pyarrow, tag_lines))]
+    for name, table in tables:
+        file_name = path + '/columnar/' + config.study_id + name + extension
+        if config.columnar_format == 'parquet':
+            pyarrow.parquet.write_table(table, file_name)
+        else:
+            pyarrow.feather.write_feather(table, file_name)
+    return True
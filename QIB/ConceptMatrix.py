@@ -0,0 +1,252 @@
+"""
+Name: ConceptMatrix
+Function: Sparse columnar storage of the subject x concept matrix that is exported to TranSMART.
+Company: The Hyve
+
+Concept paths are interned once into integer column identifiers. A column only stores the subjects that have a value,
+as two parallel typed arrays: the rows (int32) and the values as float64, NaN for values that are not numeric. Memory
+therefore grows with the number of retrieved values, not with subjects x concepts. The exported text must be exactly
+what XNAT returned, so the text of a value is kept as well, but only when it differs from the formatted float (e.g.
+"n/a" or "1.50"). Dense NumPy arrays with a missing-value mask are built on demand and are not cached.
+
+Requirements:
+numpy
+"""
+
+from array import array
+from bisect import bisect_left
+
+import numpy
+
+
+def format_number(number):
+    """
+    Function: Formats a float the way it is usually written, integers without a decimal point.
+    Parameters:
+        -number     Float       Parsed value.
+    Returns:
+        -text       String      Formatted value.
+    """
+    if number.is_integer() and abs(number) < 1e15:
+        return str(int(number))
+    return repr(number)
+
+
+class ConceptColumn(object):
+    """
+    The values of one concept, sorted by row.
+    """
+    __slots__ = ('row_ids', 'numbers', 'texts')
+
+    def __init__(self):
+        self.row_ids = array('i')
+        self.numbers = array('d')
+        # Position in row_ids -> text, only for values that format_number does not reproduce.
+        self.texts = None
+
+    def text(self, position):
+        if self.texts is not None and position in self.texts:
+            return self.texts[position]
+        return format_number(self.numbers[position])
+
+    def set(self, row, value):
+        try:
+            number = float(value)
+        except ValueError:
+            number = numpy.nan
+        position = bisect_left(self.row_ids, row)
+        if position < len(self.row_ids) and self.row_ids[position] == row:
+            self.numbers[position] = number
+        else:
+            if position < len(self.row_ids):
+                # Rows are normally filled in order, an earlier row moves the texts after it one position up.
+                if self.texts:
+                    self.texts = dict((p + 1 if p >= position else p, t) for p, t in self.texts.items())
+            self.row_ids.insert(position, row)
+            self.numbers.insert(position, number)
+        if number == number and format_number(number) == value:
+            if self.texts:
+                self.texts.pop(position, None)
+        else:
+            if self.texts is None:
+                self.texts = {}
+            self.texts[position] = value
+
+    def remove(self, row):
+        position = bisect_left(self.row_ids, row)
+        if position < len(self.row_ids) and self.row_ids[position] == row:
+            del self.row_ids[position]
+            del self.numbers[position]
+            if self.texts:
+                self.texts = dict((p - 1 if p > position else p, t) for p, t in self.texts.items() if p != position)
+
+
+class ConceptMatrix(object):
+
+    def __init__(self):
+        self.subject_header = 'subject'
+        self.concept_ids = {}
+        self.columns = []
+        self.subjects = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def intern(self, concept_key):
+        """
+        Function: Returns the column identifier of a concept key, registering a new column if it is unseen.
+        Parameters:
+            -concept_key    String      Concept key for TranSMART.
+        Returns:
+            -concept_id     Integer     Index of the column in the column registry.
+        """
+        concept_id = self.concept_ids.get(concept_key)
+        if concept_id is None:
+            concept_id = len(self.columns)
+            self.concept_ids[concept_key] = concept_id
+            self.columns.append(concept_key)
+            self.values.append(ConceptColumn())
+        return concept_id
+
+    def add_row(self, subject):
+        """
+        Function: Adds an empty row for a subject.
+        Parameters:
+            -subject    String      Subject identifier as written in the SUBJ_ID column.
+        Returns:
+            -row        Integer     Index of the new row.
+        """
+        self.subjects.append(subject)
+        return len(self.subjects) - 1
+
+    def set_value(self, row, concept_key, value):
+        """
+        Function: Stores a value in the matrix. None or an empty string removes the value.
+        Parameters:
+            -row            Integer     Row of the subject, as returned by add_row.
+            -concept_key    String      Concept key for TranSMART.
+            -value          String      Value as retrieved from XNAT.
+        Returns:
+            -is_new         Boolean     True if the concept key was not yet in the column registry.
+        """
+        is_new = concept_key not in self.concept_ids
+        column = self.values[self.intern(concept_key)]
+        if value is None or value == '':
+            column.remove(row)
+        else:
+            column.set(row, value)
+        return is_new
+
+    def value(self, concept_id, row):
+        """
+        Function: Returns a single value.
+        Parameters:
+            -concept_id     Integer     Index of the column in the column registry.
+            -row            Integer     Row of the subject.
+        Returns:
+            -value          String      Value as retrieved from XNAT, None if missing.
+        """
+        column = self.values[concept_id]
+        position = bisect_left(column.row_ids, row)
+        if position < len(column.row_ids) and column.row_ids[position] == row:
+            return column.text(position)
+        return None
+
+    def column_values(self, concept_id):
+        """
+        Function: Iterates over the values of a column.
+        Parameters:
+            -concept_id     Integer     Index of the column in the column registry.
+        Returns:
+            -values         Generator   Tuples of (row, float value or NaN, value as retrieved), sorted by row.
+        """
+        column = self.values[concept_id]
+        for position, row in enumerate(column.row_ids):
+            yield row, column.numbers[position], column.text(position)
+
+    def sparse_column(self, concept_id):
+        """
+        Function: Returns the stored arrays of a column.
+        Parameters:
+            -concept_id     Integer             Index of the column in the column registry.
+        Returns:
+            -row_ids        numpy.ndarray       Rows with a value, ascending.
+            -numbers        numpy.ndarray       Float values of those rows, NaN where not numeric.
+        """
+        column = self.values[concept_id]
+        if not len(column.row_ids):
+            return numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0)
+        # Copies, so the arrays of the column can still grow while the result is in use.
+        return (numpy.frombuffer(column.row_ids, dtype=numpy.int32).copy(),
+                numpy.frombuffer(column.numbers, dtype=numpy.float64).copy())
+
+    def header_list(self):
+        """
+        Function: Returns the headers of the clinical data file, the subject column first.
+        """
+        return [self.subject_header] + self.columns
+
+    def numeric_matrix(self, concept_ids=None):
+        """
+        Function: Expands the matrix, or a block of its columns, to dense float arrays.
+        Parameters:
+            -concept_ids    List                Columns to expand, None expands all columns.
+        Returns:
+            -numbers        numpy.ndarray       Subjects x concepts float array, NaN where missing or not numeric.
+            -missing        numpy.ndarray       Subjects x concepts boolean mask, True where no value was retrieved.
+        """
+        if concept_ids is None:
+            concept_ids = range(len(self.columns))
+        numbers = numpy.full((len(self.subjects), len(concept_ids)), numpy.nan)
+        missing = numpy.ones((len(self.subjects), len(concept_ids)), dtype=bool)
+        for index, concept_id in enumerate(concept_ids):
+            row_ids, column_numbers = self.sparse_column(concept_id)
+            numbers[row_ids, index] = column_numbers
+            missing[row_ids, index] = False
+        return numbers, missing
+
+    def rows(self, concept_ids=None, row_ids=None):
+        """
+        Function: Serialises the matrix to the rows of the clinical data file, one row at a time.
+        Parameters:
+            -concept_ids    List        Columns to serialise after the subject column, None serialises all columns.
+            -row_ids        List        Rows to serialise in ascending order, None serialises all rows.
+        Returns:
+            -rows   Generator   Per subject a list of cells, each ending with a tab and the last with a newline.
+        """
+        if concept_ids is None:
+            concept_ids = range(len(self.columns))
+        if row_ids is None:
+            row_ids = range(len(self.subjects))
+        columns = [self.values[concept_id] for concept_id in concept_ids]
+        # Per column the position of the first stored row that has not been serialised yet.
+        positions = [0] * len(columns)
+        for row in row_ids:
+            cells = [self.subjects[row] + '\t']
+            for index, column in enumerate(columns):
+                position = positions[index]
+                column_rows = column.row_ids
+                if position < len(column_rows) and column_rows[position] < row:
+                    position = bisect_left(column_rows, row, position)
+                    positions[index] = position
+                if position < len(column_rows) and column_rows[position] == row:
+                    cells.append(column.text(position) + '\t')
+                    positions[index] = position + 1
+                else:
+                    cells.append('\t')
+            cells[-1] = cells[-1][:-1] + '\n'
+            yield cells
+
+    def present_rows(self, concept_ids):
+        """
+        Function: Finds the rows with a value in at least one of the given columns.
+        Parameters:
+            -concept_ids    List        Indices of the columns in the column registry.
+        Returns:
+            -row_ids        Set         Rows with at least one value.
+        """
+        row_ids = set()
+        for concept_id in concept_ids:
+            row_ids.update(self.values[concept_id].row_ids)
+        return row_ids
@@ -65,6 +65,85 @@ class ConfigStorage(object):
         self.top_node = config_params.get('Study', 'TOP_NODE')
         self.append_facts = config_params.get('Study', 'APPEND_FACTS')
         self.base_path = config_params.get('Directory', 'path')
+        self.split_clinical = config_params.has_option('Clinical', 'SPLIT_BY_CATEGORY') and \
+            config_params.get('Clinical', 'SPLIT_BY_CATEGORY').upper() == 'Y'
+        self.set_qc_conf(config_params)
+        self.columnar = config_params.has_section('Columnar')
+        self.columnar_format = 'parquet'
+        if config_params.has_option('Columnar', 'format'):
+            self.columnar_format = config_params.get('Columnar', 'format').lower()
+        self.set_daemon_conf(config_params)
+        self.set_database_conf(config_params)
+        self.export_buffer_size = 1024 * 1024
+        if config_params.has_option('Export', 'buffer_size'):
+            self.export_buffer_size = int(config_params.get('Export', 'buffer_size'))
+        self.export_archive = config_params.has_option('Export', 'archive') and \
+            config_params.get('Export', 'archive').upper() == 'Y'
+        self.format_workers = 0
+        if config_params.has_option('Export', 'format_workers'):
+            self.format_workers = int(config_params.get('Export', 'format_workers'))
+        self.set_memory_conf(config_params)
+
+    def set_qc_conf(self, config_params):
+        """
+        Function: Sets the variables for the optional QC stage, which is enabled by a [QC] section.
+        Parameters:
+             -config_params     String      Path to configuration file
+        """
+        self.qc = config_params.has_section('QC')
+        self.qc_outlier_factor = 1.5
+        if self.qc and config_params.has_option('QC', 'outlier_factor'):
+            self.qc_outlier_factor = config_params.getfloat('QC', 'outlier_factor')
+
+    def set_daemon_conf(self, config_params):
+        """
+        Function: Sets the variables for the daemon mode from the optional [Daemon] section.
+        Parameters:
+             -config_params     String      Path to configuration file
+        """
+        def get_option(option, default):
+            if config_params.has_option('Daemon', option):
+                return config_params.get('Daemon', option)
+            return default
+
+        self.daemon_interval = float(get_option('interval', 300))
+        self.daemon_batch_threshold = int(get_option('batch_threshold', 50))
+        self.daemon_batch_deadline = float(get_option('batch_deadline', 3600))
+        self.daemon_health_file = get_option('health_file', self.base_path + self.study_id + '_health.json')
+        self.daemon_state_file = get_option('state_file', self.base_path + self.study_id + '_state.json')
+
+    def set_memory_conf(self, config_params):
+        """
+        Function: Sets the memory budgets per stage from the optional [Memory] section, used with --trace-memory.
+        Parameters:
+             -config_params     String      Path to configuration file
+        """
+        self.memory_top = 10
+        self.memory_budgets = {}
+        if config_params.has_section('Memory'):
+            for option, value in config_params.items('Memory'):
+                if option == 'top':
+                    self.memory_top = int(value)
+                elif value.strip():
+                    self.memory_budgets[option] = float(value)
+
+    def set_database_conf(self, config_params):
+        """
+        Function: Sets the variables for loading directly into PostgreSQL from the optional [Database] section.
+        Parameters:
+             -config_params     String      Path to configuration file
+        """
+        def get_option(option, default):
+            if config_params.has_option('Database', option):
+                return config_params.get('Database', option)
+            return default
+
+        self.database = config_params.has_section('Database')
+        self.database_dsn = get_option('dsn', '')
+        self.database_schema = get_option('schema', 'i2b2demodata')
+        self.database_metadata_schema = get_option('metadata_schema', 'i2b2metadata')
+        self.database_batch_size = int(get_option('batch_size', 10000))
+        self.database_create_tables = get_option('create_tables', 'N').upper() == 'Y'
 
     def set_tags_conf(self, config_tags):
         """
@@ -72,4 +151,17 @@ class ConfigStorage(object):
         Parameters:
            -config_tags     String      Path to configuration file
         """
-        self.tag_list = config_tags.get('Tags', 'Taglist').split(', ')
\ No newline at end of file
+        self.tag_list = config_tags.get('Tags', 'Taglist').split(', ')
+        self.set_filter_conf(config_tags)
+
+    def set_filter_conf(self, config_tags):
+        """
+        Function: Sets the whitelists from the optional [Filter] section, None means everything is selected.
+        Parameters:
+           -config_tags     String      Path to configuration file
+        """
+        for option in ('categories', 'biomarkers', 'lateralities', 'timepoints'):
+            selection = None
+            if config_tags.has_option('Filter', option):
+                selection = set(item.strip() for item in config_tags.get('Filter', option).split(',') if item.strip())
+            setattr(self, 'filter_' + option, selection or None)
\ No newline at end of file
@@ -0,0 +1,239 @@
+"""
+Name: DatabaseExport
+Function: Loads the subject x concept matrix and the metadata tags directly into a TranSMART/i2b2 style PostgreSQL
+schema with COPY, without the round-trip through the text files.
+Company: The Hyve
+
+All rows are streamed with COPY in batches of batch_size rows inside a single transaction. The previous facts, concepts
+and tags of the study are removed in the same transaction, so a reload replaces the study and a failed load leaves the
+database untouched. Incremental loads of the daemon only replace the facts of the subjects they contain.
+
+Format of the optional [Database] section in the params configuration file:
+
+[Database]
+dsn =               (libpq connection string, e.g. host=localhost dbname=transmart user=tm_cz)
+schema =            (schema of patient_dimension, concept_dimension and observation_fact, default i2b2demodata)
+metadata_schema =   (schema of i2b2_tags, default i2b2metadata)
+batch_size =        (rows per COPY, default 10000)
+create_tables =     (Y creates the tables if they do not exist, for testing against an empty database, default N)
+
+Requirements:
+psycopg2    Only needed when the [Database] section is present.
+"""
+
+import csv
+import hashlib
+import io
+import logging
+import sys
+from datetime import datetime
+
+import numpy
+
+TABLES = {
+    'patient_dimension': ['patient_num', 'sourcesystem_cd'],
+    'concept_dimension': ['concept_cd', 'concept_path', 'name_char', 'sourcesystem_cd'],
+    'observation_fact': ['encounter_num', 'patient_num', 'concept_cd', 'provider_id', 'start_date', 'modifier_cd',
+                         'instance_num', 'valtype_cd', 'tval_char', 'nval_num', 'sourcesystem_cd'],
+    'i2b2_tags': ['path', 'tag', 'tag_type', 'tags_idx'],
+}
+
+# nval_num is numeric(18,5), so at most 13 digits before the decimal point.
+NVAL_NUM_LIMIT = 1e13
+
+CREATE_TABLES = [
+    "CREATE SCHEMA IF NOT EXISTS {schema}",
+    "CREATE SCHEMA IF NOT EXISTS {metadata_schema}",
+    "CREATE TABLE IF NOT EXISTS {schema}.patient_dimension (patient_num integer PRIMARY KEY, "
+    "sourcesystem_cd varchar(50))",
+    "CREATE TABLE IF NOT EXISTS {schema}.concept_dimension (concept_cd varchar(50) PRIMARY KEY, "
+    "concept_path varchar(700) NOT NULL, name_char varchar(2000), sourcesystem_cd varchar(50))",
+    "CREATE TABLE IF NOT EXISTS {schema}.observation_fact (encounter_num integer, patient_num integer NOT NULL, "
+    "concept_cd varchar(50) NOT NULL, provider_id varchar(50), start_date timestamp, modifier_cd varchar(100), "
+    "instance_num integer, valtype_cd varchar(50), tval_char varchar(255), nval_num numeric(18,5), "
+    "sourcesystem_cd varchar(50))",
+    "CREATE TABLE IF NOT EXISTS {metadata_schema}.i2b2_tags (tag_id serial PRIMARY KEY, path varchar(400), "
+    "tag varchar(1000), tag_type varchar(400), tags_idx integer)",
+]
+
+
+def concept_path(config, concept_key):
+    """
+    Function: Returns the full TranSMART path of a concept key.
+    Parameters:
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+        -concept_key    String                  Concept key for TranSMART, relative to the top node.
+    Returns:
+        -path           String                  Path below TOP_NODE, ending with a backslash.
+    """
+    return config.top_node.rstrip('\\') + '\\' + concept_key + '\\'
+
+
+def concept_code(config, concept_key):
+    """
+    Function: Returns a stable concept code, so reloading a study keeps the codes of its concepts.
+    Parameters:
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+        -concept_key    String                  Concept key for TranSMART.
+    Returns:
+        -concept_cd     String                  Hash of the study and concept key, 32 characters.
+    """
+    return hashlib.md5((config.study_id + '\\' + concept_key).encode('utf-8')).hexdigest()
+
+
+def concept_rows(concept_matrix, config):
+    """
+    Function: Generates the concept_dimension rows, one per column of the concept matrix.
+    """
+    for concept_key in concept_matrix.columns:
+        yield (concept_code(config, concept_key), concept_path(config, concept_key), concept_key.split('\\')[-1],
+               config.study_id)
+
+
+def fact_rows(concept_matrix, patient_nums, config, start_date):
+    """
+    Function: Generates the observation_fact rows, numeric values as valtype N and all other values as valtype T.
+              Infinite values and values that do not fit nval_num numeric(18,5) are loaded as valtype T, they would
+              abort the load.
+    Parameters:
+        -concept_matrix     ConceptMatrix           Subject x concept matrix with all the retrieved values.
+        -patient_nums       Dictionary              Key = subject, value = patient_num.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+        -start_date         String                  Start date of the observations.
+    """
+    for concept_id, concept_key in enumerate(concept_matrix.columns):
+        concept_cd = concept_code(config, concept_key)
+        for row, number, value in concept_matrix.column_values(concept_id):
+            patient_num = patient_nums[concept_matrix.subjects[row]]
+            if numpy.isfinite(number) and abs(number) < NVAL_NUM_LIMIT:
+                yield (patient_num, patient_num, concept_cd, '@', start_date, '@', 1, 'N', 'E', value, config.study_id)
+            else:
+                yield (patient_num, patient_num, concept_cd, '@', start_date, '@', 1, 'T', value, None,
+                       config.study_id)
+
+
+def tag_rows(tag_lines, config):
+    """
+    Function: Generates the i2b2_tags rows from the lines of tags.txt.
+    """
+    for line in tag_lines:
+        if line:
+            path, title, description, weight = line.split('\t')
+            yield (concept_path(config, path), description, title, int(weight))
+
+
+def copy_rows(cursor, table, rows, batch_size):
+    """
+    Function: Streams rows into a table with COPY, batch_size rows per COPY.
+    Parameters:
+        -cursor         psycopg2 cursor     Cursor inside the load transaction.
+        -table          String              Schema qualified table name.
+        -rows           Iterable            Tuples in the column order of TABLES, None is written as NULL.
+        -batch_size     Integer             Number of rows per COPY.
+    Returns:
+        -count          Integer             Number of rows copied.
+    """
+    columns = TABLES[table.split('.')[-1]]
+    statement = "COPY " + table + " (" + ", ".join(columns) + ") FROM STDIN WITH (FORMAT csv)"
+    count = 0
+    buffer = io.StringIO() if sys.version_info.major == 3 else io.BytesIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    batch_count = 0
+    for row in rows:
+        # In CSV format an unquoted empty field is NULL and a quoted empty string is an empty string.
+        writer.writerow(['' if value is None else value for value in row])
+        batch_count += 1
+        if batch_count == batch_size:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            count += batch_count
+            batch_count = 0
+            buffer.seek(0)
+            buffer.truncate()
+    if batch_count:
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+        count += batch_count
+    return count
+
+
+def write_database(concept_matrix, tag_lines, config, incremental=False):
+    """
+    Function: Loads the patients, concepts, observations and tags of the study into PostgreSQL in one transaction.
+    Parameters:
+        -concept_matrix     ConceptMatrix           Subject x concept matrix with all the retrieved values.
+        -tag_lines          List                    Tag lines as written to tags.txt, without the header.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+        -incremental        Boolean                 Replace only the loaded subjects instead of the whole study.
+    Returns:
+        -counts             Dictionary              Number of rows loaded per table, None if psycopg2 is not installed.
+    """
+    try:
+        import psycopg2
+    except ImportError:
+        print("psycopg2 not installed, database load skipped")
+        logging.error("psycopg2 not installed, database load skipped.")
+        return None
+
+    schema = config.database_schema
+    metadata_schema = config.database_metadata_schema
+    top_path = config.top_node.rstrip('\\') + '\\'
+    counts = {}
+    connection = psycopg2.connect(config.database_dsn)
+    try:
+        with connection.cursor() as cursor:
+            if config.database_create_tables:
+                for statement in CREATE_TABLES:
+                    cursor.execute(statement.format(schema=schema, metadata_schema=metadata_schema))
+
+            # Subjects keep their patient_num between loads, new subjects are numbered after the highest one.
+            cursor.execute("LOCK TABLE " + schema + ".patient_dimension IN SHARE ROW EXCLUSIVE MODE")
+            cursor.execute("SELECT sourcesystem_cd, patient_num FROM " + schema + ".patient_dimension")
+            existing = dict(cursor.fetchall())
+            cursor.execute("SELECT coalesce(max(patient_num), 0) FROM " + schema + ".patient_dimension")
+            next_patient_num = cursor.fetchone()[0] + 1
+            patient_nums = {}
+            new_patients = []
+            for subject in concept_matrix.subjects:
+                sourcesystem_cd = config.study_id + ':' + subject
+                if sourcesystem_cd in existing:
+                    patient_nums[subject] = existing[sourcesystem_cd]
+                elif subject not in patient_nums:
+                    patient_nums[subject] = next_patient_num
+                    new_patients.append((next_patient_num, sourcesystem_cd))
+                    next_patient_num += 1
+
+            if incremental:
+                # Only the loaded subjects, concepts and tag paths are replaced, the rest of the study stays.
+                tag_paths = list(set(row[0] for row in tag_rows(tag_lines, config)))
+                concept_cds = [concept_code(config, concept_key) for concept_key in concept_matrix.columns]
+                cursor.execute("DELETE FROM " + schema + ".observation_fact WHERE sourcesystem_cd = %s AND "
+                               "patient_num = ANY(%s)", (config.study_id, list(patient_nums.values())))
+                cursor.execute("DELETE FROM " + schema + ".concept_dimension WHERE concept_cd = ANY(%s)",
+                               (concept_cds,))
+                cursor.execute("DELETE FROM " + metadata_schema + ".i2b2_tags WHERE path = ANY(%s)", (tag_paths,))
+            else:
+                cursor.execute("DELETE FROM " + schema + ".observation_fact WHERE sourcesystem_cd = %s",
+                               (config.study_id,))
+                cursor.execute("DELETE FROM " + schema + ".concept_dimension WHERE sourcesystem_cd = %s",
+                               (config.study_id,))
+                cursor.execute("DELETE FROM " + metadata_schema + ".i2b2_tags WHERE left(path, length(%s)) = %s",
+                               (top_path, top_path))
+
+            batch_size = config.database_batch_size
+            start_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            counts['patient_dimension'] = copy_rows(cursor, schema + '.patient_dimension', new_patients, batch_size)
+            counts['concept_dimension'] = copy_rows(cursor, schema + '.concept_dimension',
+                                                    concept_rows(concept_matrix, config), batch_size)
+            counts['observation_fact'] = copy_rows(cursor, schema + '.observation_fact',
+                                                   fact_rows(concept_matrix, patient_nums, config, start_date),
+                                                   batch_size)
+            counts['i2b2_tags'] = copy_rows(cursor, metadata_schema + '.i2b2_tags', tag_rows(tag_lines, config),
+                                            batch_size)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return counts
@@ -0,0 +1,317 @@
+"""
+Name: ExportWriter
+Function: Writes an export to a staging directory and moves it to its final timestamped directory in one rename, together
+with a manifest of the line counts and checksums of all its files.
+Company: The Hyve
+
+The files are written with large buffers and are not flushed while the export runs. Only commit syncs them to disk, once
+per file, before the staging directory is renamed. A run that fails before commit never leaves a directory with the final
+name behind, so a TranSMART loader only ever sees complete exports.
+
+With archive = Y the files are also streamed into <path>.tar.gz for transfer. Every file is compressed while it is
+written, as a separate gzip member of the archive, and appended to the archive when it is closed. Concatenated gzip
+members are a single valid gzip stream, so files that are written at the same time (tags.txt is open during the whole
+run) do not have to be read back and compressed afterwards.
+
+Format of the optional [Export] section in the params configuration file:
+
+[Export]
+buffer_size =       (write buffer per file in bytes, default 1048576)
+archive =           (Y also writes <path>.tar.gz with the same files and manifest, default N)
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+STAGING_SUFFIX = '.partial'
+MANIFEST_NAME = 'manifest.json'
+ARCHIVE_EXTENSION = '.tar.gz'
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+
+class ArchiveMember(object):
+    """
+    Content of one file of the archive, compressed as a gzip member while it is written.
+    """
+
+    def __init__(self, buffer_size):
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.spool = tempfile.SpooledTemporaryFile(max_size=buffer_size)
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.spool.write(self.compressor.compress(data))
+
+    def finish(self):
+        """
+        Function: Pads the content to a whole number of tar blocks and ends the gzip member.
+        """
+        padding = -self.size % tarfile.BLOCKSIZE
+        self.spool.write(self.compressor.compress(tarfile.NUL * padding))
+        self.spool.write(self.compressor.flush())
+        self.spool.seek(0)
+
+
+class ArchiveWriter(object):
+    """
+    Gzip compressed tar archive, to which complete members are appended in the order they are finished.
+    """
+
+    def __init__(self, file_name, prefix, buffer_size):
+        self.file_name = file_name
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.tar_size = 0
+        self.file = open(file_name + STAGING_SUFFIX, 'wb', buffering=buffer_size)
+
+    def member(self):
+        return ArchiveMember(self.buffer_size)
+
+    def add(self, name, member):
+        """
+        Function: Appends a finished member to the archive.
+        Parameters:
+            -name       String          Path of the file relative to the export directory.
+            -member     ArchiveMember   Compressed content of the file.
+        """
+        member.finish()
+        info = tarfile.TarInfo(self.prefix + '/' + name)
+        info.size = member.size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+        with self.lock:
+            self.file.write(gzip.compress(header))
+            shutil.copyfileobj(member.spool, self.file, self.buffer_size)
+            self.tar_size += len(header) + member.size + (-member.size % tarfile.BLOCKSIZE)
+        member.spool.close()
+
+    def add_file(self, name, file_name):
+        """
+        Function: Appends a file that was not written through the export writer and computes its manifest entry.
+        Parameters:
+            -name           String          Path of the file relative to the export directory.
+            -file_name      String          Path to the file.
+        Returns:
+            -entry          Dictionary      Number of lines, size in bytes and SHA-256 checksum of the file.
+        """
+        member = self.member()
+        entry = file_entry(file_name, member)
+        self.add(name, member)
+        return entry
+
+    def close(self):
+        """
+        Function: Writes the end of archive blocks, syncs the archive and gives it its final name.
+        """
+        # Two zero blocks end the archive, the rest pads it to a whole tar record like tarfile does.
+        end_size = 2 * tarfile.BLOCKSIZE
+        end_size += -(self.tar_size + end_size) % tarfile.RECORDSIZE
+        self.file.write(gzip.compress(tarfile.NUL * end_size))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.file_name + STAGING_SUFFIX, self.file_name)
+
+    def abort(self):
+        """
+        Function: Removes the unfinished archive.
+        """
+        self.file.close()
+        os.remove(self.file_name + STAGING_SUFFIX)
+
+
+class ExportFile(object):
+    """
+    Text file of an export, which counts the lines and computes the checksum of everything written to it.
+    """
+
+    def __init__(self, staging_path, name, buffer_size, archive=None):
+        self.relative_name = name
+        self.name = os.path.join(staging_path, name)
+        self.lines = 0
+        self.size = 0
+        self.checksum = hashlib.sha256()
+        self.closed = False
+        self.file = open(self.name, 'wb', buffering=buffer_size)
+        self.archive = archive
+        self.member = archive.member() if archive else None
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.checksum.update(data)
+        self.lines += data.count(b'\n')
+        self.size += len(data)
+        self.file.write(data)
+        if self.member:
+            self.member.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        # Flushing is left to the buffer and to commit, which syncs every file once.
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+            if self.member:
+                self.archive.add(self.relative_name, self.member)
+
+    def entry(self):
+        """
+        Function: Returns the manifest entry of the file.
+        """
+        return {'lines': self.lines, 'bytes': self.size, 'sha256': self.checksum.hexdigest()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def file_entry(file_name, member=None):
+    """
+    Function: Computes the manifest entry of a file that was not written through the export writer.
+    Parameters:
+        -file_name      String          Path to the file.
+        -member         ArchiveMember   Archive member that receives the content of the file, None without archive.
+    Returns:
+        -entry          Dictionary      Number of lines, size in bytes and SHA-256 checksum of the file.
+    """
+    checksum = hashlib.sha256()
+    lines = 0
+    size = 0
+    with open(file_name, 'rb') as read_file:
+        for block in iter(lambda: read_file.read(DEFAULT_BUFFER_SIZE), b''):
+            checksum.update(block)
+            lines += block.count(b'\n')
+            size += len(block)
+            if member:
+                member.write(block)
+    return {'lines': lines, 'bytes': size, 'sha256': checksum.hexdigest()}
+
+
+def fsync_path(path):
+    """
+    Function: Syncs a file or directory to disk. Directories cannot be opened on every platform, those are skipped.
+    Parameters:
+        -path       String      Path to the file or directory.
+    """
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(descriptor)
+
+
+class ExportWriter(object):
+    """
+    Staging directory of one export, committed to its final path with a single rename.
+    """
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE, archive=False):
+        if os.path.exists(path):
+            raise ValueError('Path already exists: {0}'.format(path))
+        self.path = path
+        self.staging_path = path + STAGING_SUFFIX
+        self.buffer_size = buffer_size
+        self.files = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.staging_path + "/tags/")
+        os.makedirs(self.staging_path + "/clinical/")
+        self.archive = None
+        if archive:
+            self.archive = ArchiveWriter(path + ARCHIVE_EXTENSION, os.path.basename(os.path.abspath(path)),
+                                         buffer_size)
+
+    def open(self, name):
+        """
+        Function: Opens a file of the export for writing.
+        Parameters:
+            -name           String          Path of the file relative to the export directory, e.g. tags/tags.txt.
+        Returns:
+            -export_file    ExportFile      File object that is closed and synced by commit.
+        """
+        export_file = ExportFile(self.staging_path, name, self.buffer_size, self.archive)
+        with self.lock:
+            self.files[name] = export_file
+        return export_file
+
+    def manifest(self):
+        """
+        Function: Collects the manifest entries of all the files in the staging directory. Files written through the
+                  writer use the counts and checksums computed while writing, other files (QC report, columnar files,
+                  subject log) are read once, and added to the archive in the same pass.
+        Returns:
+            -manifest       Dictionary      Key = path relative to the export directory, value = manifest entry.
+        """
+        manifest = {}
+        for directory, directory_names, file_names in os.walk(self.staging_path):
+            for file_name in file_names:
+                full_name = os.path.join(directory, file_name)
+                name = os.path.relpath(full_name, self.staging_path).replace(os.sep, '/')
+                if name in self.files:
+                    manifest[name] = self.files[name].entry()
+                elif self.archive:
+                    manifest[name] = self.archive.add_file(name, full_name)
+                else:
+                    manifest[name] = file_entry(full_name)
+        return manifest
+
+    def commit(self):
+        """
+        Function: Closes and syncs all files, writes the manifest and renames the staging directory to the final path.
+                  The archive is completed last, so an archive with its final name always belongs to a complete export.
+        Returns:
+            -path       String      Path to the committed export directory.
+        """
+        for export_file in self.files.values():
+            export_file.close()
+        manifest = self.manifest()
+        with open(os.path.join(self.staging_path, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump({'files': manifest}, manifest_file, indent=2, sort_keys=True)
+        if self.archive:
+            self.archive.add_file(MANIFEST_NAME, os.path.join(self.staging_path, MANIFEST_NAME))
+
+        for directory, directory_names, file_names in os.walk(self.staging_path):
+            for file_name in file_names:
+                fsync_path(os.path.join(directory, file_name))
+            fsync_path(directory)
+        os.rename(self.staging_path, self.path)
+        if self.archive:
+            self.archive.close()
+        fsync_path(os.path.dirname(os.path.abspath(self.path)))
+        logging.info("Export committed to " + self.path)
+        return self.path
+
+    def abort(self):
+        """
+        Function: Removes the staging directory of a failed export.
+        """
+        for export_file in self.files.values():
+            export_file.close()
+        if self.archive:
+            self.archive.abort()
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+        logging.error("Export to " + self.path + " aborted.")
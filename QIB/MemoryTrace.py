@@ -0,0 +1,144 @@
+"""
+Name: MemoryTrace
+Function: Records the peak and retained memory of every stage of a run with tracemalloc, lists the source lines that
+allocated the retained memory and checks the peaks against configured budgets.
+Company: The Hyve
+
+Enabled with --trace-memory of QIBconverter.py. Tracing slows the run down considerably, so it is meant for benchmark
+runs, e.g. against XNATStandIn.py, and not for production. QIBconverter.py checks the budgets before the export is
+committed and again at the end of the run. A stage that exceeds its budget stops the run with MemoryBudgetError after
+the report is written, an export that is not yet committed is aborted, so memory regressions fail the benchmark.
+
+Format of the optional [Memory] section in the params configuration file:
+
+[Memory]
+top =               (number of allocation sites listed per stage, default 10)
+total =             (budget in MB for the peak of the whole run)
+<stage> =           (budget in MB for the peak during a stage, e.g. obtain_data = 2048, write_data = 512)
+"""
+
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 1024.0 * 1024.0
+REPORT_HEADERS = ['Stage', 'Peak MB', 'Retained MB', 'Seconds', 'Budget MB']
+SITE_HEADERS = ['Stage', 'Allocation site', 'Retained KB', 'Retained blocks']
+# Allocations of tracemalloc itself and of the import machinery say nothing about the importer.
+SNAPSHOT_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+                    tracemalloc.Filter(False, '<unknown>')]
+
+
+class MemoryBudgetError(Exception):
+    """
+    Raised when the peak memory of a stage or of the whole run exceeds its budget.
+    """
+
+
+class MemoryTracer(object):
+    """
+    Collects the memory use per stage. When disabled every stage is a no-op, so the stages can stay in the code.
+    """
+
+    def __init__(self, budgets=None, top=10, enabled=True):
+        self.budgets = budgets or {}
+        self.top = top
+        self.enabled = enabled
+        self.stages = []
+        self.peak = 0
+
+    def start(self):
+        """
+        Function: Starts tracing the allocations.
+        """
+        if self.enabled:
+            tracemalloc.start()
+
+    def stop(self):
+        """
+        Function: Stops tracing and frees the traces.
+        """
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Function: Measures the memory use of the code inside the with block.
+        Parameters:
+            -name       String      Name of the stage, also the name of its budget in the [Memory] section.
+        """
+        if not self.enabled:
+            yield
+            return
+        before_current = tracemalloc.get_traced_memory()[0]
+        before = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        # Without reset_peak (Python < 3.9) the peak of a stage includes the peaks of the stages before it.
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+        sites = [site for site in after.compare_to(before, 'lineno') if site.size_diff > 0][:self.top]
+        self.peak = max(self.peak, peak)
+        self.stages.append({'stage': name, 'peak': peak, 'retained': current - before_current, 'seconds': seconds,
+                            'sites': sites})
+        logging.info("Memory " + name + ": peak {0:.1f} MB, retained {1:.1f} MB".format(
+            peak / MB, (current - before_current) / MB))
+
+    def exceeded(self):
+        """
+        Function: Compares the recorded peaks with the budgets.
+        Returns:
+            -exceeded   List        Messages for every stage, or the whole run, that exceeded its budget.
+        """
+        exceeded = []
+        for stage in self.stages:
+            budget = self.budgets.get(stage['stage'])
+            if budget is not None and stage['peak'] > budget * MB:
+                exceeded.append("{0} peak {1:.1f} MB exceeds budget of {2} MB".format(stage['stage'],
+                                                                                       stage['peak'] / MB, budget))
+        budget = self.budgets.get('total')
+        if budget is not None and self.peak > budget * MB:
+            exceeded.append("total peak {0:.1f} MB exceeds budget of {1} MB".format(self.peak / MB, budget))
+        return exceeded
+
+    def write_report(self, file_name):
+        """
+        Function: Writes the memory use per stage and the top allocation sites per stage.
+        Parameters:
+            -file_name      String      Path to the report file.
+        """
+        with open(file_name, 'w') as report_file:
+            report_file.write('\t'.join(REPORT_HEADERS) + '\n')
+            for stage in self.stages:
+                budget = self.budgets.get(stage['stage'])
+                report_file.write('\t'.join([stage['stage'], '{0:.1f}'.format(stage['peak'] / MB),
+                                             '{0:.1f}'.format(stage['retained'] / MB),
+                                             '{0:.2f}'.format(stage['seconds']),
+                                             '' if budget is None else str(budget)]) + '\n')
+            budget = self.budgets.get('total')
+            report_file.write('\t'.join(['total', '{0:.1f}'.format(self.peak / MB), '', '',
+                                         '' if budget is None else str(budget)]) + '\n')
+            report_file.write('\n' + '\t'.join(SITE_HEADERS) + '\n')
+            for stage in self.stages:
+                for site in stage['sites']:
+                    frame = site.traceback[0]
+                    report_file.write('\t'.join([stage['stage'], frame.filename + ':' + str(frame.lineno),
+                                                 '{0:.1f}'.format(site.size_diff / 1024.0),
+                                                 str(site.count_diff)]) + '\n')
+
+    def check(self):
+        """
+        Function: Raises MemoryBudgetError if a budget is exceeded.
+        """
+        exceeded = self.exceeded()
+        if exceeded:
+            for message in exceeded:
+                logging.critical("Memory budget exceeded: " + message)
+            raise MemoryBudgetError('; '.join(exceeded))
@@ -7,21 +7,51 @@ Company: The Hyve
 
 Requirements:
 xnatpy      Downloadable here: https://bitbucket.org/bigr_erasmusmc/xnatpy
+numpy
 
 """
 
 import os
+import re
 import sys
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import xnat
 
+import ColumnarExport
+import DatabaseExport
+import ExportWriter
+import MemoryTrace
+import QualityControl
+from ConceptMatrix import ConceptMatrix
+from ConceptPath import ConceptPathBuilder, OrderedTagWriter
+
 if sys.version_info.major == 3:
     import configparser as ConfigParser
 elif sys.version_info.major == 2:
     import ConfigParser
 
 
+class SessionInfo(namedtuple('SessionInfo', ['laterality', 'timepoint', 'accession_identifiers', 'scanner',
+                                             'scanner_model', 'scanner_manufacturer'])):
+    """
+    Base session information of a QIB experiment. Resolved once per experiment by get_session_data and used for both
+    the concept path and the tags, so the base sessions are not requested from XNAT again for every biomarker.
+    """
+    __slots__ = ()
+
+    def metadata(self):
+        """
+        Function: Returns the metadata that is written as tags of every concept of the experiment.
+        Returns:
+            -metadata   List    Tuples of (tag title, value).
+        """
+        return [("laterality", self.laterality), ("timepoint", self.timepoint), ("scanner model", self.scanner_model),
+                ("scanner manufacturer", self.scanner_manufacturer), ("scanner", self.scanner)]
+
+
 def make_connection(config):
     """
     Function: Create the connection to XNAT.
@@ -55,72 +85,80 @@ def make_connection(config):
             return e, None
 
 
-def create_dir(config, timestamp):
+def open_file(path, name, export=None):
     """
-    Function: Create the directory structure.
+    Function: Opens a file of the export for writing, through the export writer when there is one.
     Parameters:
-        -config  ConfigStorage object    Object which holds the information stored in the configuration files.
-    Returns: 
-        -path    String                  Path to the directory where all the files will be saved.
+        -path       String                  Path to the directory where all the files will be saved.
+        -name       String                  Path of the file relative to path, e.g. tags/tags.txt.
+        -export     ExportWriter            Staging directory of the export, None to write directly to path.
+    Returns:
+        -file       File                    Opened file.
     """
-
-    path = config.base_path + config.study_id + timestamp
-    if os.path.exists(path):
-        raise ValueError('Path already exists: {0}'.format(path))
-    ## Make paths
-    os.makedirs(path + "/tags/", exist_ok=True)
-    os.makedirs(path + "/clinical/", exist_ok=True)
-    return path
+    if export:
+        return export.open(name)
+    return open(path + '/' + name, 'w')
 
 
-def write_params(path, config):
+def write_params(path, config, export=None, append_facts=None):
     """
     Function: Uses the configuration files to write the .params files.
     Parameters:
-        -path       String                  Path to the directory where all the files will be saved.
-        -config     ConfigStorage object    Object which holds the information stored in the configuration files.
+        -path           String                  Path to the directory where all the files will be saved.
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+        -export         ExportWriter            Staging directory of the export, None to write directly to path.
+        -append_facts   String                  Overrides APPEND_FACTS of the configuration, None keeps it.
     """
-    tag_param_file = open(path + '/tags/tags.params', 'w')
+    if append_facts is None:
+        append_facts = config.append_facts
+    tag_param_file = open_file(path, 'tags/tags.params', export)
     tag_param_file.write("TAGS_FILE=tags.txt")
-    study_param_file = open(path + '/study.params', 'w')
+    study_param_file = open_file(path, 'study.params', export)
     study_param_file.write("STUDY_ID=" + config.study_id +
                            "\nSECURITY_REQUIRED=" + config.security_req +
                            "\nTOP_NODE=" + config.top_node +
-                           "\nAPPEND_FACTS=" + config.append_facts)
-    clinical_param_file = open(path + '/clinical/clinical.params', 'w')
+                           "\nAPPEND_FACTS=" + append_facts)
+    clinical_param_file = open_file(path, 'clinical/clinical.params', export)
     clinical_param_file.write("COLUMN_MAP_FILE=" + str(config.study_id) + "_columns.txt\nTAGS_FILE=../tags/tags.txt")
     tag_param_file.close()
     study_param_file.close()
     clinical_param_file.close()
 
 
-def write_headers(path, config):
+def write_headers(path, config, export=None):
     """
     Function: Uses the configuration files to write the headers of the .txt files. 
     Parameters:
         -path           String                  Path to the directory where all the files will be saved.
         -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+        -export         ExportWriter            Staging directory of the export, None to write directly to path.
     Returns:
         -tag_file        File                   tags.txt, used to upload the metadata into TranSMART.
         -data_file       File                   (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
+                                                None if the clinical data is split over several files.
         -concept_file    File                   (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
     """
 
-    data_file = open(path + '/clinical/' + config.study_id + '_clinical.txt', 'w')
-    concept_file = open(path + '/clinical/' + config.study_id + '_columns.txt', 'w')
-    tag_file = open(path + '/tags/tags.txt', 'w')
+    data_file = None
+    if not config.split_clinical:
+        data_file = open_file(path, 'clinical/' + config.study_id + '_clinical.txt', export)
+    concept_file = open_file(path, 'clinical/' + config.study_id + '_columns.txt', export)
+    tag_file = open_file(path, 'tags/tags.txt', export)
     # Hardcoded right now, because transmart does not need other headers. But this can be subject to change.
     concept_headers = ['Filename', 'Category Code', 'Column Number', 'Data Label']
     tag_headers = ['Concept Path', 'Title', 'Description', 'Weight']
     concept_file.write("\t".join(concept_headers) + '\n')
     tag_file.write("\t".join(tag_headers) + "\n")
-    tag_file.flush()
-    data_file.flush()
-    concept_file.flush()
+    if export is None:
+        # Files of an export writer are synced once by commit, plain files are flushed like before.
+        tag_file.flush()
+        if data_file:
+            data_file.flush()
+        concept_file.flush()
     return tag_file, data_file, concept_file
 
 
-def obtain_data(project, tag_file, patient_map, config):
+def obtain_data(project, tag_file, patient_map, config, subject_labels=None):
     """
     Function: Obtains all the QIB data from the XNAT project.
     Parameters: 
@@ -128,156 +166,129 @@ def obtain_data(project, tag_file, patient_map, config):
         -tag_file            File                    tags.txt, used to upload the metadata into TranSMART.
         -patient_map         Dictionary              Dictionary with the patient mapping with the XNAT identifier as key.
         -config              ConfigStorage object    Object which holds the information stored in the configuration files.
+        -subject_labels      List                    Labels of the subjects to retrieve, None retrieves all subjects.
     Returns:
-        -data_list           List                     List containing directories per subject, key = header, value = value.
-        -data_header_list    List                     List containing all the headers.
+        -concept_matrix      ConceptMatrix           Subject x concept matrix with all the retrieved values.
     """
-    concept_key_list = []
-    data_header_list = []
-    data_list = []
+    concept_matrix = ConceptMatrix()
+    concept_paths = ConceptPathBuilder()
+    tag_writer = OrderedTagWriter(tag_file, config.format_workers)
     tag_dict = {}
     scanner_dict = {}
     with open(config.scanner_dict_file) as f:
         for line in f:
             (key, val) = line.replace('\n','').split('\t')
             scanner_dict[key] = val
-    for subject in project.subjects.values():
-        data_row_dict = {}
+    if subject_labels is None:
+        subjects = project.subjects.values()
+    else:
+        subjects = []
+        for label in subject_labels:
+            # A subject can be removed from XNAT between the poll and the export, that must not stop the others.
+            if label in project.subjects:
+                subjects.append(project.subjects[label])
+            else:
+                logging.warning("Subject " + str(label) + " not found in XNAT, skipped.")
+    for subject in subjects:
+        row = None
         subject_obj = project.subjects[subject.label]
         for experiment in subject_obj.experiments.values():
             if "qib" in experiment.label.lower() and experiment.project == config.project_name:
-                # TODO: Make number of returns and parameters less.
-                data_header_list, data_row_dict, concept_key_list, tag_dict, scanner_dict = retrieve_QIB(experiment,
-                                                                                           tag_file, data_row_dict,
-                                                                                           subject, data_header_list,
-                                                                                           concept_key_list, tag_dict,
-                                                                                           patient_map, config,
-                                                                                           scanner_dict, project)
-        if len(data_row_dict) > 0:
-            data_list.append(data_row_dict)
-
-    if data_list == [{}] or data_list == []:
+                row, tag_dict, scanner_dict = retrieve_QIB(experiment, tag_writer, concept_matrix, row, subject,
+                                                           tag_dict, patient_map, config, scanner_dict, project,
+                                                           concept_paths)
+    tag_writer.close()
+
+    if len(concept_matrix) == 0:
         logging.warning("No QIB datatypes found.")
         print("No QIB datatypes found.\nExit")
         if __name__ == "__main__":
             sys.exit()
-        else:
-            return data_list
 
-    return data_list, data_header_list
+    return concept_matrix
 
 
-def retrieve_QIB(experiment, tag_file, data_row_dict, subject, data_header_list, concept_key_list, tag_dict,
-                 patient_map, config, scanner_dict ,project):
+def retrieve_QIB(experiment, tag_file, concept_matrix, row, subject, tag_dict, patient_map, config, scanner_dict,
+                 project, concept_paths):
     """
     Function: Retrieve the biomarker information from the QIB datatype.
     
     Parameters:
-        -subject_obj         Xnatpy.subject          Subject object derived from XNATpy
         -experiment          Xnatpy.experiment       Experiment object derived from XNATpy
-        -tag_file            File                    File used to write the metadata tags to
-        -data_row_dict       Dict                    Dictionary for storing the subject information, headers = key
+        -tag_file            OrderedTagWriter        Writer of the metadata tags.
+        -concept_matrix      ConceptMatrix           Subject x concept matrix the values are stored in.
+        -row                 Integer                 Row of the subject in concept_matrix, None if not added yet.
         -subject             Subject                 Subject derived from XNATpy
-        -data_header_list    List                    List used for storing all the headers
-        -concept_key_list    List                    List used for storing the concept keys
         -tag_dict            Dictionary              Dictionary used to check if certain lines are already in the tagsfile.
         -patient_map         Dictionary              Dictionary with the patient mapping with the XNAT identifier as key.
         -config              ConfigStorage object    Object which holds the information stored in the configuration files.
+        -scanner_dict        Dictionary              Dictionary with the scanner numbers, key = manufacturer + model.
+        -project             xnatpy object           Xnat connection to a specific project.
+        -concept_paths       ConceptPathBuilder      Builder of the concept keys, shared by all experiments.
     
     Returns:
-        -data_header_list    List            List with the headers stored
-        -data_row_dict       Dictionary      Dict containing all the QIB information of the subject
-        -concept_key_list    List            List containing all the concept keys so far.
+        -row                 Integer         Row of the subject in concept_matrix.
         -tag_dict            Dictionary      Dictionary used to check if certain lines are already in the tagsfile.
+        -scanner_dict        Dictionary      Dictionary with the scanner numbers, key = manufacturer + model.
     """
     subject_obj = project.subjects[subject.label]
     session = subject_obj.experiments[experiment.label]
-    begin_concept_key, tag_dict = write_project_metadata(session, tag_file, tag_dict, config)
-
-    if subject.label in patient_map:
-        data_row_dict['subject'] = patient_map[subject.label]
-    else:
-        data_row_dict['subject'] = subject.label
-    if 'subject' not in data_header_list:
-        data_header_list.append('subject')
 
     label_list = experiment.label.split('_')
-    metadata, scanner_dict = get_session_data(label_list, project, session.base_sessions.values(), scanner_dict, config)
-    for x in metadata:
-        if "scanner " in x:
-            line = '\t'.join([begin_concept_key+'\\'+metadata["scanner"], x, str(metadata[x])]) + "\t" + str(1) + "\n"
-            if line not in tag_dict:
-                tag_file.write(line)
-                tag_dict[line] = True
+    session_info, scanner_dict = get_session_data(label_list, project, session, scanner_dict, config)
+    if session_info is None:
+        return row, tag_dict, scanner_dict
 
+    selected_biomarkers = []
     for biomarker_category in session.biomarker_categories:
         results = session.biomarker_categories[biomarker_category]
+        if not is_selected(results.category_name, config.filter_categories):
+            continue
 
         for biomarker in results.biomarkers:
-            biomarker_id = results.biomarkers[biomarker].id
-            concept_value = results.biomarkers[biomarker].value
+            if is_selected(results.biomarkers[biomarker].id, config.filter_biomarkers):
+                selected_biomarkers.append((results, biomarker))
 
-            concept_path_items = [
-                str(begin_concept_key),
-                str(metadata["scanner"]),
-                str(results.category_name),
-                metadata["laterality"],
-                metadata["timepoint"],
-                str(biomarker_id)
-            ]
-            concept_key = '\\'.join(concept_path_items)
+    if not selected_biomarkers:
+        return row, tag_dict, scanner_dict
 
-            data_row_dict[concept_key] = concept_value
+    begin_concept_key, tag_dict = write_project_metadata(session, tag_file, tag_dict, config)
 
-            if concept_key not in data_header_list and concept_key not in concept_key_list:
-                data_header_list.append(concept_key)
-                concept_key_list.append(concept_key)
+    if row is None:
+        row = concept_matrix.add_row(patient_map.get(subject.label, subject.label))
 
-                if __name__ == "QIB2TBatch":
-                    tag_dict = write_concept_tags(results, biomarker, concept_key, tag_file, tag_dict, session,
-                                                  metadata)
+    for title, value in session_info.metadata():
+        if "scanner " in title:
+            line = '\t'.join([begin_concept_key+'\\'+session_info.scanner, title, str(value)]) + "\t" + str(1) + "\n"
+            if line not in tag_dict:
+                tag_file.write(line)
+                tag_dict[line] = True
 
-    return data_header_list, data_row_dict, concept_key_list, tag_dict, scanner_dict
+    new_concepts = []
+    for results, biomarker in selected_biomarkers:
+        result = results.biomarkers[biomarker]
+        concept_key = concept_paths.concept_key(begin_concept_key, session_info.scanner, results.category_name,
+                                                session_info.laterality, session_info.timepoint, result.id)
 
+        if concept_matrix.set_value(row, concept_key, result.value):
+            new_concepts.append((concept_key, result.ontology_name, result.ontology_iri))
 
-def write_concept_tags(results, biomarker, concept_key, tag_file, tag_dict, session, metadata):
-    """
+    if __name__ == "QIB2TBatch":
+        tag_file.write_concept_tags(new_concepts, session_info)
 
-    Parameters:
-        -results            XNAT object         Parsed QIB XML object.
-        -biomarker          XNAT object         biomarker from parsed XML.
-        -concept_key        String              concept key for TranSMART
-        -concept_key_list   List                List containing the already used concept keys.
-        -tag_file           File                File for the metadata tags.
-        -tag_dict           Dictionary          Dictionary used to check if certain lines are already in the tagsfile.
-        -session            Xnatpy.session      Session object from xnatpy, used to retrieve the accession identifier.
+    return row, tag_dict, scanner_dict
 
-    Returns:
-        -concept_key_list     List          List containing the already used concept keys.
-        -tag_dict             Dictionary    Dictionary used to check if certain lines are already in the tagsfile.
 
+def is_selected(value, selection):
     """
-    ontology_name = results.biomarkers[biomarker].ontology_name
-    ontology_IRI = results.biomarkers[biomarker].ontology_iri
-    lines = []
-    weight = 1
-    lines.append('\t'.join([concept_key, "Ontology name", ontology_name]) + '\t' + str(weight) + '\n')
-    lines.append('\t'.join([concept_key, "Ontology IRI", ontology_IRI]) + '\t' + str(weight) + '\n')
-    weight = 2
-
-    for x in session.base_sessions.values():
-        lines.append(
-            '\t'.join([concept_key, "accession identifier", x.accession_identifier]) + "\t" + str(weight) + "\n")
-
-    for x in metadata:
-        lines.append('\t'.join([concept_key, x, str(metadata[x])]) + "\t" + str(weight) + "\n")
-
-    for line in lines:
-        if (concept_key+x) not in tag_dict.keys():
-            tag_dict[line] = True
-            tag_file.write(line)
-
-    return tag_dict
+    Function: Checks a value against a whitelist from the [Filter] section of the configuration.
+    Parameters:
+        -value          String      Value to check, e.g. a category name or biomarker ID.
+        -selection      Set         Whitelisted values, None if everything is selected.
+    Returns:
+        -selected       Boolean     True if the value is whitelisted.
+    """
+    return selection is None or str(value) in selection
 
 
 def write_project_metadata(session, tag_file, tag_dict, config):
@@ -318,48 +329,178 @@ def write_project_metadata(session, tag_file, tag_dict, config):
     return concept_key, tag_dict
 
 
-def write_data(data_file, concept_file, data_list, data_header_list):
+def write_data(data_file, concept_file, concept_matrix):
     """
-    Function: Writes the data from data_list to data_file.
+    Function: Writes the data from concept_matrix to data_file.
     Parameters: 
-        -data_file           File    (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
-        -concept_file        File    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
-        -data_list           List    List containing a directory per subject, key = header, value = value.
-        -data_header_list    List    List containing all the headers.
-    """
-    data_file.write("\t".join(data_header_list) + '\n')
-    column_list = []
-    subject_written = False
-    for line in data_list:
-        row = []
-        i = 0
-
-        while i < len(data_header_list):
-            row.append('\t')
-            i += 1
-
-        for header in data_header_list:
-            if header in line.keys():
-                info_piece = line[header]
-                index = data_header_list.index(header)
-                row[index] = info_piece + '\t'
-                if header == "subject" and subject_written == False:
-                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(header) + '\t' + str(
-                        index + 1) + '\tSUBJ_ID\n')
-                    subject_written = True
-                    column_list.append(header)
-                elif header not in column_list:
-                    data_label = header.split("\\")[-1]
-                    column_list.append(header)
-                    concept_file.write(str(os.path.basename(data_file.name)) + '\t' + str(
-                        "\\".join(header.split("\\")[:-1])) + '\t' + str(index + 1) + '\t' + str(data_label) + '\n')
-        row[-1] = row[-1].replace('\t', '\n')
+        -data_file           File            (STUDY_ID)_clinical.txt, used to upload the clinical data into TranSMART.
+        -concept_file        File            (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
+        -concept_matrix      ConceptMatrix   Subject x concept matrix with all the retrieved values.
+    """
+    data_file_name = str(os.path.basename(data_file.name))
+    data_file.write("\t".join(concept_matrix.header_list()) + '\n')
+    if len(concept_matrix) > 0:
+        concept_file.write(data_file_name + '\t' + str(concept_matrix.subject_header) + '\t1\tSUBJ_ID\n')
+        for index, header in enumerate(concept_matrix.columns):
+            header_items = header.split("\\")
+            concept_file.write(data_file_name + '\t' + "\\".join(header_items[:-1]) + '\t' + str(index + 2) + '\t' +
+                               header_items[-1] + '\n')
+    for row in concept_matrix.rows():
         found_info, found_subject = check_subject(row)
         if not found_info:
             data_file.write(''.join(row))
     data_file.close()
 
 
+def split_columns(concept_matrix):
+    """
+    Function: Groups the columns of the concept matrix per analysis tool and category.
+    Parameters:
+        -concept_matrix     ConceptMatrix   Subject x concept matrix with all the retrieved values.
+    Returns:
+        -groups             List            Tuples of (group name, list of column indices), in order of first column.
+    """
+    groups = {}
+    for concept_id, concept_key in enumerate(concept_matrix.columns):
+        items = concept_key.split("\\")
+        # Concept keys are tool\scanner\category\laterality\timepoint\biomarker, the scanner is not part of the group.
+        group = ' '.join([items[0], items[2]]) if len(items) >= 6 else items[0]
+        groups.setdefault(group, []).append(concept_id)
+    return sorted(groups.items(), key=lambda group: group[1][0])
+
+
+def write_split_data(path, concept_file, concept_matrix, config, export=None):
+    """
+    Function: Writes the data from concept_matrix to a clinical data file per analysis tool and category, each with
+              its own SUBJ_ID column and only the subjects with a value in that file. The files are written in parallel.
+    Parameters:
+        -path                String                  Path to the directory where all the files will be saved.
+        -concept_file        File                    (STUDY_ID)_columns.txt, used to determine which values are in which columns for uploading to TranSMART.
+        -concept_matrix      ConceptMatrix           Subject x concept matrix with all the retrieved values.
+        -config              ConfigStorage object    Object which holds the information stored in the configuration files.
+        -export              ExportWriter            Staging directory of the export, None to write directly to path.
+    """
+    # The subject log is checked once for the complete row of a subject, as in write_data.
+    row_ids = [row_id for row_id, row in enumerate(concept_matrix.rows()) if not check_subject(row)[0]]
+
+    file_names = set()
+    files = []
+    for group, concept_ids in split_columns(concept_matrix):
+        file_name = config.study_id + '_' + re.sub('[^0-9A-Za-z]+', '_', group).strip('_') + '_clinical.txt'
+        while file_name in file_names:
+            file_name = file_name[:-len('_clinical.txt')] + '_' + str(len(files)) + '_clinical.txt'
+        file_names.add(file_name)
+        files.append((file_name, concept_ids))
+
+        concept_file.write(file_name + '\t' + str(concept_matrix.subject_header) + '\t1\tSUBJ_ID\n')
+        for index, concept_id in enumerate(concept_ids):
+            header_items = concept_matrix.columns[concept_id].split("\\")
+            concept_file.write(file_name + '\t' + "\\".join(header_items[:-1]) + '\t' + str(index + 2) + '\t' +
+                               header_items[-1] + '\n')
+
+    def write_file(file_name, concept_ids):
+        present_rows = concept_matrix.present_rows(concept_ids)
+        with open_file(path, 'clinical/' + file_name, export) as data_file:
+            data_file.write("\t".join([concept_matrix.subject_header] +
+                                      [concept_matrix.columns[concept_id] for concept_id in concept_ids]) + '\n')
+            for row in concept_matrix.rows(concept_ids, [row_id for row_id in row_ids if row_id in present_rows]):
+                data_file.write(''.join(row))
+
+    if files:
+        with ThreadPoolExecutor(max_workers=min(len(files), 8)) as executor:
+            for future in [executor.submit(write_file, file_name, concept_ids) for file_name, concept_ids in files]:
+                future.result()
+
+
+def export_data(project, config, patient_map, timestamp, subject_labels=None, tracer=None):
+    """
+    Function: Writes an export directory: the .params files, the headers, the data obtained from XNAT, the QC report,
+              the clinical data and columnar files, then commits it and loads the database. Used by QIBconverter for
+              the full export and by QIBdaemon for the incremental ones.
+    Parameters:
+        -project            xnatpy object           Xnat connection to a specific project.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+        -patient_map        Dictionary              Dictionary with the patient mapping with the XNAT identifier as key.
+        -timestamp          String                  Suffix of the export directory and the subject log.
+        -subject_labels     List                    Labels of the subjects of an incremental export, None exports all
+                                                    subjects.
+        -tracer             MemoryTracer            Memory use per stage, None does not trace.
+    Returns:
+        -path               String                  Path to the committed export directory.
+    """
+    if tracer is None:
+        tracer = MemoryTrace.MemoryTracer(enabled=False)
+    incremental = subject_labels is not None
+
+    print('Creating directory structure')
+    export = ExportWriter.ExportWriter(config.base_path + config.study_id + timestamp, config.export_buffer_size,
+                                       config.export_archive)
+    path = export.staging_path
+    subject_logger = None
+
+    try:
+        print('Write .params files')
+        # With APPEND_FACTS=N the loader would delete the facts of every subject that is not in an incremental export.
+        write_params(path, config, export, append_facts='Y' if incremental else None)
+
+        print('Write headers')
+        tag_file, data_file, concept_file = write_headers(path, config, export)
+        if config.columnar or config.database:
+            tag_file = ColumnarExport.TagRecorder(tag_file)
+
+        print('Obtaining data from XNAT')
+        with tracer.stage('obtain_data'):
+            concept_matrix = obtain_data(project, tag_file, patient_map, config, subject_labels)
+        logging.info("Data obtained from XNAT.")
+
+        if config.qc:
+            print('Run QC on the biomarker values')
+            with tracer.stage('qc'):
+                flag_count = QualityControl.write_qc_report(concept_matrix, path, config)
+            print('{0} values flagged, see {1}/QC_report.txt'.format(flag_count, export.path))
+            logging.info("QC report written.")
+
+        # Every export logs its subjects to its own directory, check_subject reads the first handler.
+        subject_logger = set_subject_logger(False, path, timestamp, config)
+
+        print('Write data to files')
+        with tracer.stage('write_data'):
+            if config.split_clinical:
+                write_split_data(path, concept_file, concept_matrix, config, export)
+            else:
+                write_data(data_file, concept_file, concept_matrix)
+        logging.info("Data written to files.")
+
+        if config.columnar:
+            print('Write columnar files')
+            with tracer.stage('columnar'):
+                written = ColumnarExport.write_columnar(path, concept_matrix, tag_file.lines, config)
+            if written:
+                logging.info("Columnar files written.")
+
+        close_subject_logger(subject_logger)
+        # An export that exceeded a budget is never committed.
+        tracer.check()
+        with tracer.stage('commit'):
+            path = export.commit()
+        print('Commit export to', path)
+        if config.export_archive:
+            print('Archive written to', export.archive.file_name)
+    except BaseException:
+        close_subject_logger(subject_logger)
+        export.abort()
+        raise
+
+    if config.database:
+        print('Load data into the database')
+        with tracer.stage('database'):
+            counts = DatabaseExport.write_database(concept_matrix, tag_file.lines, config, incremental=incremental)
+        if counts is not None:
+            print('Rows loaded:', counts)
+            logging.info("Data loaded into the database.")
+    return path
+
+
 def check_subject(row):
     """
     Function: Checks in a log file if the subject is new or if there is information added or removed.
@@ -452,6 +593,18 @@ def set_subject_logger(test_bool, path, timestamp, config=None):
     return subject_logger
 
 
+def close_subject_logger(subject_logger):
+    """
+    Function: Closes the subject log of the export, so it is complete before the export is committed.
+    Parameters:
+        -subject_logger     Logger      Logger returned by set_subject_logger, None if it was not set yet.
+    """
+    if subject_logger:
+        for handler in list(subject_logger.handlers):
+            subject_logger.removeHandler(handler)
+            handler.close()
+
+
 def get_patient_mapping(config):
     """
     Function: Parse the patient mapping file to a dictionary.
@@ -468,33 +621,41 @@ def get_patient_mapping(config):
     return patient_dict
 
 
-def get_session_data(label_list, project, sessions, scanner_dict, config):
+def get_session_data(label_list, project, session, scanner_dict, config):
     """
-    Function: get metadata from session through accession number
+    Function: Resolves the base session information of a QIB experiment through the accession identifiers, walking
+              the base sessions only once. The laterality and timepoint of the base session, which take precedence
+              over the label, are checked against the [Filter] section before the scanner is looked up, so excluded
+              experiments do not add scanners to the scanner file.
     Parameters:
-        -subject_obj    xnatpy object   Object which contains the sessions
-        -label_list     List            parsed list of the label
+        -label_list     List                    Parsed list of the label.
+        -project        xnatpy object           Xnat connection to a specific project.
+        -session        xnatpy object           QIB experiment.
+        -scanner_dict   Dictionary              Dictionary with the scanner numbers, key = manufacturer + model.
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
     Returns:
-        -metadata       Dictionary      Dictionary with metadata stored inside it.
+        -session_info   SessionInfo             Base session information of the experiment, None if the laterality or
+                                                timepoint is excluded.
+        -scanner_dict   Dictionary              Dictionary with the scanner numbers, key = manufacturer + model.
     """
-
-    metadata = {}
-    #TODO: Add parameter to config for scanner dict file. read file to dict and look up scanner/model to determin scanner number.
-    _session = [project.experiments[x.accession_identifier] for x in sessions][0]
-    metadata["laterality"] = _session._fields.get('laterality', label_list[3])
-    metadata["timepoint"] = _session._fields.get('timepoint', label_list[4])
+    accession_identifiers = tuple(x.accession_identifier for x in session.base_sessions.values())
+    _session = project.experiments[accession_identifiers[0]]
+    laterality = _session._fields.get('laterality', label_list[3])
+    timepoint = _session._fields.get('timepoint', label_list[4])
+    if not (is_selected(laterality, config.filter_lateralities) and is_selected(timepoint, config.filter_timepoints)):
+        return None, scanner_dict
     _session = project.experiments['_'.join(label_list[1:])]
-    #metadata["scanner"] = _session.get('scanner') or label_list[2]
-    metadata["scanner model"] = _session.get('scanner/model') or "Not specified"
-    metadata["scanner manufacturer"] = _session.get('scanner/manufacturer') or "Not specified"
-    scanner_name = metadata["scanner manufacturer"]+metadata["scanner model"]
+    scanner_model = _session.get('scanner/model') or "Not specified"
+    scanner_manufacturer = _session.get('scanner/manufacturer') or "Not specified"
+    scanner_name = scanner_manufacturer + scanner_model
     if scanner_dict.get(scanner_name):
-        metadata["scanner"] = "scanner" + str(scanner_dict.get(metadata["scanner manufacturer"] +
-                                                               metadata["scanner model"]))
+        scanner = "scanner" + str(scanner_dict.get(scanner_name))
     else:
         scanner_number = len(scanner_dict)+1
-        metadata["scanner"] = "scanner"+str(scanner_number)
+        scanner = "scanner"+str(scanner_number)
         with open(config.scanner_dict_file, 'a') as f:
             f.write(scanner_name+'\t'+str(scanner_number)+'\n')
         scanner_dict[scanner_name] = scanner_number
-    return metadata, scanner_dict
+    session_info = SessionInfo(laterality, timepoint, accession_identifiers, scanner, scanner_model,
+                               scanner_manufacturer)
+    return session_info, scanner_dict
@@ -9,9 +9,14 @@ Parameters:
 --connection    Location of the configuration file for establishing XNAT connection.
 --params        Location of the configuration file for the variables in the .param files.
 --tags          Location of the configuration file for the tags.
+--daemon        Keep polling XNAT and write incremental exports, see QIBdaemon.py.
+--trace-memory  Write a report of the memory use per stage and fail if a [Memory] budget is exceeded, see MemoryTrace.py.
+                The budgets are checked before the export is committed, an export that exceeds one is aborted. Not
+                available with --daemon.
 
 Requirements:
 xnatpy      Downloadable here: https://bitbucket.org/bigr_erasmusmc/xnatpy
+numpy
 
 Formats of configuration files:
 
@@ -34,11 +39,39 @@ TOP_NODE =
 [Directory]
 path =
 
+[Clinical]          (optional)
+SPLIT_BY_CATEGORY = (Y writes a clinical data file per analysis tool and category, default N)
+
+[Columnar]          (optional, also writes the data and tags as typed columnar files, requires pyarrow)
+format =            (parquet or arrow, default parquet)
+
+[Export]            (optional, the export is written to <path>.partial and renamed when complete, see ExportWriter.py)
+buffer_size =       (write buffer per file in bytes, default 1048576)
+archive =           (Y also streams the files into <path>.tar.gz while they are written, default N)
+format_workers =    (threads formatting the tag lines while the data is fetched, default 0, see ConceptPath.py)
+
+[Database]          (optional, also loads the data into PostgreSQL, requires psycopg2, see DatabaseExport.py)
+dsn =
+
+[Memory]            (optional, budgets in MB for --trace-memory, see MemoryTrace.py)
+total =
+obtain_data =
+write_data =
+
+[QC]                (optional, enables the QC report)
+outlier_factor =    (optional, default 1.5)
+
 --tags configuration file:
 
 [Tags]
 Taglist =
 
+[Filter]            (optional, comma separated whitelists)
+categories =
+biomarkers =
+lateralities =
+timepoints =
+
 
 """
 
@@ -50,16 +83,36 @@ import sys
 import time
 from datetime import datetime
 
+import MemoryTrace
 import QIB2TBatch
+import QIBdaemon
 from ConfigStorage import ConfigStorage
 
 
+def write_memory_report(tracer, report_name):
+    """
+    Function: Writes the memory report of a traced run and stops tracing.
+    Parameters:
+        -tracer         MemoryTracer    Memory use per stage of the run.
+        -report_name    String          Path to the report file.
+    """
+    if tracer.enabled:
+        tracer.write_report(report_name)
+        tracer.stop()
+        print('Memory report written to', report_name)
+
+
 def main(args):
     """
     Function: Call all the methods, passing along all the needed variables.
     Parameters:
         -args   ArgumentParser      Contains the location of the configuration files.
     """
+    if args.daemon and args.trace_memory:
+        # The daemon never finishes, so there would be no report and no budget check.
+        print("--trace-memory cannot be combined with --daemon")
+        sys.exit(1)
+
     start = time.time()
     timestamp = datetime.now().strftime("_%Y%m%d%H%M%S")
     logging.info("Start.")
@@ -71,17 +124,19 @@ def main(args):
         print(config.error)
         sys.exit()
 
-    print('Establishing connection')
-    project, connection = QIB2TBatch.make_connection(config)
+    tracer = MemoryTrace.MemoryTracer(config.memory_budgets, config.memory_top, enabled=args.trace_memory)
+    report_name = config.base_path + config.study_id + timestamp + '_memory.txt'
+    tracer.start()
 
-    print('Creating directory structure')
-    path = QIB2TBatch.create_dir(config, timestamp)
-
-    print('Write .params files')
-    QIB2TBatch.write_params(path, config)
+    print('Establishing connection')
+    with tracer.stage('connect'):
+        project, connection = QIB2TBatch.make_connection(config)
 
-    print('Write headers')
-    tag_file, data_file, concept_file = QIB2TBatch.write_headers(path, config)
+    if args.daemon:
+        print('Polling XNAT for new QIB experiments')
+        QIBdaemon.run(project, connection, config)
+        connection.disconnect()
+        return
 
     print('Load patient mapping')
     patient_map = QIB2TBatch.get_patient_mapping(config)
@@ -90,17 +145,23 @@ def main(args):
     else:
         print('Found the following patient map:',patient_map, sep='\n')
 
-    print('Obtaining data from XNAT')
-    data_list, data_header_list = QIB2TBatch.obtain_data(project, tag_file, patient_map, config)
-    logging.info("Data obtained from XNAT.")
+    try:
+        QIB2TBatch.export_data(project, config, patient_map, timestamp, tracer=tracer)
+    except MemoryTrace.MemoryBudgetError as e:
+        write_memory_report(tracer, report_name)
+        print('Memory budget exceeded, export aborted:', e)
+        sys.exit(1)
 
-    subject_logger = QIB2TBatch.set_subject_logger(False, path, timestamp,config)
+    connection.disconnect()
 
-    print('Write data to files')
-    QIB2TBatch.write_data(data_file, concept_file, data_list, data_header_list)
-    logging.info("Data written to files.")
+    if tracer.enabled:
+        write_memory_report(tracer, report_name)
+        try:
+            tracer.check()
+        except MemoryTrace.MemoryBudgetError as e:
+            print('Memory budget exceeded:', e)
+            sys.exit(1)
 
-    connection.disconnect()
     logging.info("Exit.")
     end = time.time()
     print(end - start)
@@ -113,5 +174,9 @@ if __name__ == "__main__":
     parser.add_argument("--connection", help="Location of the configuration file for establishing XNAT connection.")
     parser.add_argument("--params", help="Location of the configuration file for the variables in the .params files.")
     parser.add_argument("--tags", help="Location of the configuration file for the tags.")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and write incremental exports of new or "
+                                                               "modified QIB experiments, see QIBdaemon.py.")
+    parser.add_argument("--trace-memory", action="store_true", help="Record the memory use per stage and check it "
+                                                                     "against the [Memory] budgets, see MemoryTrace.py.")
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,176 @@
+"""
+Name: QIBdaemon
+Function: Keep a single XNAT connection open, poll the project for new or modified QIB experiments and write
+incremental directories that can be uploaded to TranSMART.
+Company: The Hyve
+
+Started by QIBconverter.py with --daemon. Changed experiments are collected per subject and exported together once
+batch_threshold subjects are pending, or batch_deadline seconds after the first pending change. The state of the poller
+is written to a JSON health file after every poll, so it can be checked by monitoring.
+
+Format of the optional [Daemon] section in the params configuration file:
+
+[Daemon]
+interval =          (seconds between polls, default 300)
+batch_threshold =   (number of changed subjects that triggers an export, default 50)
+batch_deadline =    (maximum seconds a change waits for an export, default 3600)
+health_file =       (default <path>/<STUDY_ID>_health.json)
+state_file =        (default <path>/<STUDY_ID>_state.json)
+"""
+
+import json
+import logging
+import os
+import signal
+import sys
+import time
+from datetime import datetime
+
+import QIB2TBatch
+
+
+def poll_experiments(connection, config):
+    """
+    Function: Lists the QIB experiments of the project with a single REST call.
+    Parameters:
+        -connection     xnatpy object           Xnat wide connection.
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+    Returns:
+        -experiments    Dictionary              Key = experiment label, value = (subject label, last modification).
+    """
+    result = connection.get_json('/data/projects/' + config.project_name + '/experiments',
+                                 query={'columns': 'ID,label,subject_label,project,insert_date,last_modified'})
+    experiments = {}
+    for row in result['ResultSet']['Result']:
+        label = row.get('label', '')
+        if "qib" in label.lower() and row.get('project') == config.project_name:
+            experiments[label] = (row.get('subject_label'), row.get('last_modified') or row.get('insert_date'))
+    return experiments
+
+
+def changed_subjects(experiments, known_experiments):
+    """
+    Function: Compares a poll with the previously seen experiments.
+    Parameters:
+        -experiments        Dictionary      Result of poll_experiments.
+        -known_experiments  Dictionary      Previously seen experiments, key = label, value = last modification.
+    Returns:
+        -subjects           Set             Labels of the subjects with a new or modified QIB experiment.
+    """
+    subjects = set()
+    for label, (subject_label, modified) in experiments.items():
+        if known_experiments.get(label) != modified:
+            subjects.add(subject_label)
+    return subjects
+
+
+def clear_cache(project):
+    """
+    Function: Drops everything xnatpy cached for the project (the subject and experiment listings, the objects and
+              their data), so an export sees subjects created and experiments modified since the previous export.
+    Parameters:
+        -project        xnatpy object           Xnat connection to a specific project.
+    """
+    project.xnat_session.clearcache()
+    project.clearcache()
+
+
+def export_subjects(project, config, patient_map, subject_labels):
+    """
+    Function: Writes an incremental TranSMART directory for a set of subjects.
+    Parameters:
+        -project            xnatpy object           Xnat connection to a specific project.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+        -patient_map        Dictionary              Dictionary with the patient mapping with the XNAT identifier as key.
+        -subject_labels     List                    Labels of the subjects to export.
+    Returns:
+        -path               String                  Path to the directory the export was written to.
+    """
+    clear_cache(project)
+    timestamp = datetime.now().strftime("_%Y%m%d%H%M%S") + "_incremental"
+    path = QIB2TBatch.export_data(project, config, patient_map, timestamp, subject_labels)
+    logging.info("Incremental export of " + str(len(subject_labels)) + " subjects written to " + path)
+    return path
+
+
+def write_json(file_name, content):
+    """
+    Function: Replaces a JSON file in one step, so readers never see a partially written file.
+    Parameters:
+        -file_name      String          Path to the JSON file.
+        -content        Dictionary      Content of the file.
+    """
+    with open(file_name + '.tmp', 'w') as json_file:
+        json.dump(content, json_file, indent=2, sort_keys=True)
+    os.rename(file_name + '.tmp', file_name)
+
+
+def run(project, connection, config):
+    """
+    Function: Polls XNAT until the process is stopped, exporting the pending changes before exiting.
+    Parameters:
+        -project        xnatpy object           Xnat connection to a specific project.
+        -connection     xnatpy object           Xnat wide connection.
+        -config         ConfigStorage object    Object which holds the information stored in the configuration files.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    patient_map = QIB2TBatch.get_patient_mapping(config)
+
+    # The state holds the last seen modification of every experiment and the subjects that still await an export,
+    # so a restarted daemon neither exports everything again nor loses pending changes.
+    known_experiments = {}
+    pending = {}
+    seeded = os.path.exists(config.daemon_state_file)
+    if seeded:
+        with open(config.daemon_state_file) as state_file:
+            state = json.load(state_file)
+        known_experiments = state['experiments']
+        pending = dict((subject_label, time.time()) for subject_label in state['pending'])
+
+    health = {'status': 'starting', 'started': datetime.now().isoformat(), 'polls': 0, 'exports': 0, 'errors': 0,
+              'pending_subjects': 0, 'last_poll': None, 'last_poll_seconds': None, 'last_export': None,
+              'last_error': None}
+    try:
+        while True:
+            poll_start = time.time()
+            try:
+                experiments = poll_experiments(connection, config)
+                if seeded:
+                    for subject_label in changed_subjects(experiments, known_experiments):
+                        pending.setdefault(subject_label, poll_start)
+                else:
+                    # The first poll without a saved state only records what is already in XNAT.
+                    seeded = True
+                known_experiments = dict((label, modified) for label, (subject_label, modified) in experiments.items())
+
+                write_json(config.daemon_state_file, {'experiments': known_experiments, 'pending': sorted(pending)})
+
+                if pending and (len(pending) >= config.daemon_batch_threshold or
+                                time.time() - min(pending.values()) >= config.daemon_batch_deadline):
+                    health['last_export'] = export_subjects(project, config, patient_map, sorted(pending))
+                    health['exports'] += 1
+                    pending = {}
+                    write_json(config.daemon_state_file, {'experiments': known_experiments, 'pending': []})
+                health['status'] = 'ok'
+            except Exception as e:
+                logging.error("Poll failed: " + str(e))
+                health['status'] = 'error'
+                health['errors'] += 1
+                health['last_error'] = str(e)
+
+            health['polls'] += 1
+            health['pending_subjects'] = len(pending)
+            health['last_poll'] = datetime.now().isoformat()
+            health['last_poll_seconds'] = round(time.time() - poll_start, 3)
+            write_json(config.daemon_health_file, health)
+            time.sleep(max(0, config.daemon_interval - (time.time() - poll_start)))
+
+    except (KeyboardInterrupt, SystemExit):
+        if pending:
+            health['last_export'] = export_subjects(project, config, patient_map, sorted(pending))
+            health['exports'] += 1
+            write_json(config.daemon_state_file, {'experiments': known_experiments, 'pending': []})
+        health['status'] = 'stopped'
+        health['pending_subjects'] = 0
+        write_json(config.daemon_health_file, health)
+        logging.info("Daemon stopped.")
@@ -0,0 +1,164 @@
+"""
+Name: QualityControl
+Function: Checks the retrieved biomarker values before they are exported and writes a QC report next to the export.
+Company: The Hyve
+
+All checks work on blocks of QC_BLOCK_SIZE concepts for all subjects at once, so the cost is a handful of NumPy passes
+per block regardless of the number of subjects, while the dense arrays never hold more than one block.
+
+Requirements:
+numpy
+"""
+
+import warnings
+
+import numpy
+
+STATISTICS_HEADERS = ['Concept Path', 'Values', 'Missing', 'Non-numeric', 'Min', 'Max', 'Mean', 'Q1', 'Median', 'Q3',
+                      'Outliers']
+STATISTICS_NAMES = ['values', 'missing', 'non_numeric', 'min', 'max', 'mean', 'q1', 'median', 'q3', 'outliers']
+FLAG_HEADERS = ['Flag', 'Concept Path', 'Subject', 'Value']
+# Number of concepts that are expanded to dense arrays at the same time.
+QC_BLOCK_SIZE = 256
+
+
+def concept_statistics(numbers, missing, outlier_factor):
+    """
+    Function: Computes the statistics of every concept and flags the outliers.
+    Parameters:
+        -numbers            numpy.ndarray   Subjects x concepts float array, NaN where missing or not numeric.
+        -missing            numpy.ndarray   Subjects x concepts boolean mask, True where no value was retrieved.
+        -outlier_factor     Float           Number of interquartile ranges outside the quartiles a value is an outlier.
+    Returns:
+        -statistics         Dictionary      Arrays with one entry per concept, key = statistic.
+        -outliers           numpy.ndarray   Subjects x concepts boolean mask, True where the value is an outlier.
+        -non_numeric        numpy.ndarray   Subjects x concepts boolean mask, True where the value is not a number.
+    """
+    non_numeric = ~missing & numpy.isnan(numbers)
+    if numbers.shape[0] == 0:
+        empty = numpy.full(numbers.shape[1], numpy.nan)
+        minimum = maximum = mean = q1 = median = q3 = empty
+    else:
+        with warnings.catch_warnings():
+            # Concepts without any numeric value give all-NaN slices, those are reported as nan.
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            minimum = numpy.nanmin(numbers, axis=0)
+            maximum = numpy.nanmax(numbers, axis=0)
+            mean = numpy.nanmean(numbers, axis=0)
+            q1, median, q3 = numpy.nanpercentile(numbers, [25, 50, 75], axis=0)
+    statistics = {
+        'values': numpy.count_nonzero(~numpy.isnan(numbers), axis=0),
+        'missing': numpy.count_nonzero(missing, axis=0),
+        'non_numeric': numpy.count_nonzero(non_numeric, axis=0),
+        'min': minimum,
+        'max': maximum,
+        'mean': mean,
+        'q1': q1,
+        'median': median,
+        'q3': q3,
+    }
+    iqr = q3 - q1
+    with numpy.errstate(invalid="ignore"):
+        outliers = (numbers < q1 - outlier_factor * iqr) | (numbers > q3 + outlier_factor * iqr)
+    statistics['outliers'] = numpy.count_nonzero(outliers, axis=0)
+    return statistics, outliers, non_numeric
+
+
+def timepoint_groups(columns):
+    """
+    Function: Groups the concepts that only differ in their scanner and timepoint. The scanner is resolved per base
+              session, so the timepoints of one subject can have been acquired on different scanners.
+    Parameters:
+        -columns    List            Concept keys, as in the column registry of the concept matrix.
+    Returns:
+        -groups     Dictionary      Key = concept key with * as scanner and timepoint, value = list of
+                                    (timepoint, concept ids), only groups with at least two timepoints.
+    """
+    groups = {}
+    for concept_id, concept_key in enumerate(columns):
+        items = concept_key.split('\\')
+        if len(items) < 6:
+            continue
+        # The concept path ends with scanner, category, laterality, timepoint and biomarker.
+        group_key = '\\'.join(items[:-5] + ['*'] + items[-4:-2] + ['*', items[-1]])
+        groups.setdefault(group_key, {}).setdefault(items[-2], []).append(concept_id)
+    return dict((group_key, list(timepoints.items())) for group_key, timepoints in groups.items()
+                if len(timepoints) > 1)
+
+
+def group_gaps(group_key, timepoints, group_missing):
+    """
+    Function: Finds the subjects that lack some, but not all, timepoints of one group.
+    Parameters:
+        -group_key      String          Concept key with * as scanner and timepoint.
+        -timepoints     List            Tuples of (timepoint, concept ids) of the group.
+        -group_missing  numpy.ndarray   Subjects x timepoints boolean mask, True where no value was retrieved.
+    Returns:
+        -gaps           List            Tuples of (concept key, row, missing timepoints).
+    """
+    # Encode the missing timepoints of every subject as a bit pattern, so each distinct pattern is labelled once.
+    patterns = group_missing.dot(1 << numpy.arange(len(timepoints), dtype=numpy.int64))
+    rows = numpy.flatnonzero((patterns > 0) & (patterns < (1 << len(timepoints)) - 1))
+    labels = {}
+    for pattern in numpy.unique(patterns[rows]):
+        labels[pattern] = ','.join(timepoints[i][0] for i in range(len(timepoints)) if pattern >> i & 1)
+    return [(group_key, row, labels[pattern]) for row, pattern in zip(rows, patterns[rows])]
+
+
+def missing_timepoints(concept_matrix):
+    """
+    Function: Finds the subjects that lack a timepoint of a biomarker which is present at their other timepoints.
+    Parameters:
+        -concept_matrix     ConceptMatrix   Subject x concept matrix with all the retrieved values.
+    Returns:
+        -gaps               List            Tuples of (concept key, row, missing timepoints).
+    """
+    gaps = []
+    for group_key, timepoints in timepoint_groups(concept_matrix.columns).items():
+        group_missing = numpy.ones((len(concept_matrix), len(timepoints)), dtype=bool)
+        for index, (timepoint, concept_ids) in enumerate(timepoints):
+            # A timepoint is only missing when none of its scanners has a value.
+            numbers, missing = concept_matrix.numeric_matrix(concept_ids)
+            group_missing[:, index] = missing.all(axis=1)
+        gaps.extend(group_gaps(group_key, timepoints, group_missing))
+    return gaps
+
+
+def write_qc_report(concept_matrix, path, config):
+    """
+    Function: Runs all the checks on the concept matrix and writes QC_report.txt to the export directory.
+    Parameters:
+        -concept_matrix     ConceptMatrix           Subject x concept matrix with all the retrieved values.
+        -path               String                  Path to the directory where all the files will be saved.
+        -config             ConfigStorage object    Object which holds the information stored in the configuration files.
+    Returns:
+        -flag_count         Integer                 Number of flagged values.
+    """
+    statistics = dict((name, []) for name in STATISTICS_NAMES)
+    flags = {"Outlier": [], "Non-numeric": []}
+    # The matrix is only expanded to dense arrays one block of columns at a time.
+    for start in range(0, len(concept_matrix.columns), QC_BLOCK_SIZE):
+        concept_ids = list(range(start, min(start + QC_BLOCK_SIZE, len(concept_matrix.columns))))
+        numbers, missing = concept_matrix.numeric_matrix(concept_ids)
+        block_statistics, outliers, non_numeric = concept_statistics(numbers, missing, config.qc_outlier_factor)
+        for name in STATISTICS_NAMES:
+            statistics[name].extend(block_statistics[name])
+        for flag, mask in (("Outlier", outliers), ("Non-numeric", non_numeric)):
+            flags[flag].extend((row, start + index) for row, index in zip(*numpy.nonzero(mask)))
+
+    flag_lines = []
+    for flag in ("Outlier", "Non-numeric"):
+        for row, concept_id in sorted(flags[flag]):
+            flag_lines.append('\t'.join([flag, concept_matrix.columns[concept_id], concept_matrix.subjects[row],
+                                         concept_matrix.value(concept_id, row)]) + '\n')
+    for group_key, row, absent in missing_timepoints(concept_matrix):
+        flag_lines.append('\t'.join(["Missing timepoint", group_key, concept_matrix.subjects[row], absent]) + '\n')
+
+    with open(path + '/QC_report.txt', 'w') as report_file:
+        report_file.write("\t".join(STATISTICS_HEADERS) + '\n')
+        for concept_id, concept_key in enumerate(concept_matrix.columns):
+            report_file.write('\t'.join([concept_key] +
+                                        [str(statistics[name][concept_id]) for name in STATISTICS_NAMES]) + '\n')
+        report_file.write('\n' + "\t".join(FLAG_HEADERS) + '\n')
+        report_file.writelines(flag_lines)
+    return len(flag_lines)
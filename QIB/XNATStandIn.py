@@ -0,0 +1,341 @@
+"""
+Name: XNATStandIn
+Function: Local HTTP server that implements the XNAT REST endpoints used by the importer, serving a synthetic project,
+so the importer can be load and latency tested without a real XNAT.
+Company: The Hyve
+
+Parameters:
+--port              Port to listen on, 0 picks a free port.
+--project           ID of the synthetic project.
+--subjects          Number of subjects.
+--lateralities      Comma separated lateralities, every laterality and timepoint gets a base session and a QIB experiment.
+--timepoints        Comma separated timepoints.
+--categories        Comma separated biomarker categories of every QIB experiment.
+--biomarkers        Number of biomarkers per category.
+--scanners          Number of different scanners the base sessions are spread over.
+--latency           Seconds added to every response.
+--jitter            Maximum number of seconds randomly added to or removed from the latency.
+--error-rate        Fraction of the requests that is answered with 503 Service Unavailable.
+--schema-dir        Directory with the XSD files served under /schemas/, e.g. xnat/xnat.xsd and qib/qib.xsd, default
+                    test_files/schemas.
+--qib-type          xsi:type of the QIB experiments, as defined in the QIB schema.
+--seed              Seed for the synthetic values, the latency jitter and the errors.
+
+xnatpy builds its classes from the XSD files of the server it connects to. These are not generated. test_files/schemas
+holds the part of the XNAT and QIB schemas that the importer reads and is served by default. For other xnatpy use copy
+the XSD files from <XNAT>/schemas/ of a real server into a directory and pass it with --schema-dir.
+
+Connect the importer by setting the url in the [Connection] section to http://localhost:<port>, any user and password
+are accepted.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+if sys.version_info.major == 3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+elif sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+XNAT_VERSION = "1.6.5"
+
+
+def generate_project(args):
+    """
+    Function: Generates the synthetic project.
+    Parameters:
+        -args       ArgumentParser      Contains the size of the synthetic project.
+    Returns:
+        -store      Dictionary          Key = kind of object (projects, subjects, experiments), value = dictionary
+                                        with the objects, key = ID.
+    """
+    generator = random.Random(args.seed)
+    project = args.project
+    store = {'projects': {project: {'ID': project, 'name': project, 'secondary_ID': project}},
+             'subjects': {}, 'experiments': {}}
+    scanners = [("Manufacturer" + str(i % 3 + 1), "Model" + str(i + 1)) for i in range(max(1, args.scanners))]
+    insert_date = "2017-08-03 10:00:00.0"
+
+    for i in range(args.subjects):
+        subject_label = "SUBJ{0:05d}".format(i + 1)
+        subject_id = project + "_S{0:05d}".format(i + 1)
+        store['subjects'][subject_id] = {'ID': subject_id, 'label': subject_label, 'project': project,
+                                         'insert_date': insert_date}
+        for laterality in args.lateralities.split(','):
+            for timepoint in args.timepoints.split(','):
+                base_label = '_'.join([subject_label, "MRI", laterality, timepoint])
+                base_id = project + "_E" + str(len(store['experiments']) + 1).zfill(6)
+                manufacturer, model = scanners[generator.randrange(len(scanners))]
+                store['experiments'][base_id] = {
+                    'xsiType': 'xnat:mrSessionData', 'subject_ID': subject_id,
+                    'data_fields': {'ID': base_id, 'label': base_label, 'project': project,
+                                    'subject_ID': subject_id, 'scanner/manufacturer': manufacturer,
+                                    'scanner/model': model, 'insert_date': insert_date,
+                                    'last_modified': insert_date},
+                    # Laterality and timepoint are custom fields of the base session, like on the real XNAT.
+                    'children': [{'field': 'fields/field', 'items': [
+                        {'meta': {'xsi:type': 'xnat:experimentData_field'}, 'children': [],
+                         'data_fields': {'name': name, 'field': value}}
+                        for name, value in (('laterality', laterality), ('timepoint', timepoint))]}]}
+
+                categories = []
+                for category in args.categories.split(','):
+                    biomarkers = []
+                    for b in range(args.biomarkers):
+                        biomarkers.append({'meta': {'xsi:type': 'qib:biomarker'}, 'children': [], 'data_fields': {
+                            'id': "{0} biomarker {1} (mm^3)".format(category, b + 1),
+                            'value': repr(generator.gauss(8000, 1500)),
+                            'ontology_name': "BiomarkerOntology", 'ontology_iri': "BiomarkerIRI"}})
+                    categories.append({'meta': {'xsi:type': 'qib:biomarkerCategory'}, 'data_fields': {
+                        'category_name': category}, 'children': [{'field': 'biomarkers/biomarker',
+                                                                  'items': biomarkers}]})
+
+                qib_id = project + "_E" + str(len(store['experiments']) + 1).zfill(6)
+                store['experiments'][qib_id] = {
+                    'xsiType': args.qib_type, 'subject_ID': subject_id,
+                    'data_fields': {'ID': qib_id, 'label': "QIB_" + base_label, 'project': project,
+                                    'subject_ID': subject_id, 'analysis_tool': "StandIn Segmentation",
+                                    'analysis_tool_version': "0.1", 'description': "Synthetic QIB experiment",
+                                    'insert_date': insert_date, 'last_modified': insert_date},
+                    'children': [{'field': 'biomarker_categories/biomarker_category', 'items': categories},
+                                 {'field': 'base_sessions/base_session', 'items': [
+                                     {'meta': {'xsi:type': 'qib:baseSession'}, 'children': [],
+                                      'data_fields': {'accession_identifier': base_id}}]}]}
+    return store
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, args):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.store = store
+        self.args = args
+        self.generator = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            delay = server.args.latency + server.generator.uniform(-server.args.jitter, server.args.jitter)
+            fail = server.generator.random() < server.args.error_rate
+            if fail:
+                server.error_count += 1
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            return self.respond(503, "Service Unavailable", "text/plain")
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        try:
+            status, body, content_type = self.route(parts, query)
+        except (KeyError, IndexError, StopIteration, IOError):
+            status, body, content_type = 404, "Not Found", "text/plain"
+        self.respond(status, body, content_type)
+
+    def do_DELETE(self):
+        # xnatpy ends its session with DELETE /data/JSESSION on disconnect, nothing else can be deleted.
+        if [part for part in urlparse(self.path).path.split('/') if part] == ['data', 'JSESSION']:
+            return self.respond(200, "", "text/plain")
+        self.respond(405, "Method Not Allowed", "text/plain")
+
+    def respond(self, status, body, content_type):
+        body = body.encode('utf-8') if not isinstance(body, bytes) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def user(self):
+        authorization = self.headers.get('Authorization', '')
+        if authorization.startswith('Basic '):
+            return base64.b64decode(authorization[6:]).decode('utf-8').split(':')[0]
+        return None
+
+    def route(self, parts, query):
+        """
+        Function: Maps a request path to the synthetic project.
+        Parameters:
+            -parts      List            Path of the request split on '/'.
+            -query      Dictionary      Parsed query string of the request.
+        Returns:
+            -status         Integer     HTTP status code.
+            -body           String      Body of the response.
+            -content_type   String      Content type of the body.
+        """
+        store = self.server.store
+        if not parts:
+            return 200, self.index_page(), "text/html"
+        if parts[0] == 'schemas':
+            with open(os.path.join(self.server.args.schema_dir, *parts[1:]), 'rb') as schema_file:
+                return 200, schema_file.read(), "application/xml"
+        if parts[0] != 'data' or len(parts) < 2:
+            raise KeyError(parts)
+        if parts[1] == 'archive':
+            # xnatpy requests /data/archive/..., which XNAT serves the same as /data/...
+            parts = parts[:1] + parts[2:]
+        if parts[1:] == ['version']:
+            return 200, XNAT_VERSION, "text/plain"
+        if parts[1:] == ['JSESSION']:
+            return 200, "STANDIN" + str(self.server.request_count), "text/plain"
+
+        kind, rest = parts[1], parts[2:]
+        if kind == 'projects' and not rest:
+            return self.result_set([self.project_row(x) for x in store['projects'].values()], query)
+        if kind == 'projects':
+            project = store['projects'][rest[0]]
+            if len(rest) == 1:
+                if query.get('format', [''])[0] == 'xml':
+                    return 200, self.project_xml(project), "application/xml"
+                return self.item('xnat:projectData', project)
+            kind, rest = rest[1], rest[2:]
+            if kind == 'subjects' and not rest:
+                return self.result_set([self.subject_row(x) for x in store['subjects'].values()
+                                        if x['project'] == project['ID']], query)
+            if kind == 'experiments' and not rest:
+                return self.result_set([self.experiment_row(x) for x in store['experiments'].values()
+                                        if x['data_fields']['project'] == project['ID']], query)
+        if kind == 'subjects':
+            subject = self.lookup(store['subjects'], rest[0])
+            if len(rest) == 1:
+                return self.item('xnat:subjectData', subject)
+            if rest[1:] == ['experiments']:
+                return self.result_set([self.experiment_row(x) for x in store['experiments'].values()
+                                        if x['subject_ID'] == subject['ID']], query)
+            kind, rest = rest[1], rest[2:]
+        if kind == 'experiments' and len(rest) == 1:
+            experiment = self.lookup(store['experiments'], rest[0])
+            body = {'items': [{'meta': {'xsi:type': experiment['xsiType'], 'isHistory': False},
+                               'data_fields': experiment['data_fields'], 'children': experiment['children']}]}
+            return 200, json.dumps(body), "application/json"
+        raise KeyError(parts)
+
+    def index_page(self):
+        user = self.user()
+        if user is None:
+            return '<span id="user_info">Logged in as: <span style="color:red;">Guest</span></span>'
+        return '<span id="user_info">Logged in as: &nbsp;<a href="/app/template/XDATScreen_UpdateUser.vm">' + \
+               user + '</a></span>'
+
+    def project_xml(self, project):
+        host = "http://" + self.headers.get('Host', 'localhost')
+        schemas = []
+        for root, dirs, files in os.walk(self.server.args.schema_dir):
+            for file_name in sorted(files):
+                if file_name.endswith('.xsd'):
+                    relative_path = os.path.relpath(os.path.join(root, file_name), self.server.args.schema_dir)
+                    schemas.append(host + '/schemas/' + relative_path.replace(os.sep, '/'))
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<xnat:Project ID="{0}" ' \
+               'xmlns:xnat="http://nrg.wustl.edu/xnat" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+               'xsi:schemaLocation="{1}"><xnat:name>{0}</xnat:name></xnat:Project>'.format(
+                   project['ID'], ' '.join('http://nrg.wustl.edu/xnat ' + x for x in schemas))
+
+    @staticmethod
+    def lookup(objects, key):
+        if key in objects:
+            return objects[key]
+        return next(x for x in objects.values() if x.get('label', x.get('data_fields', {}).get('label')) == key)
+
+    @staticmethod
+    def item(xsi_type, data_fields):
+        body = {'items': [{'meta': {'xsi:type': xsi_type, 'isHistory': False}, 'data_fields': data_fields,
+                           'children': []}]}
+        return 200, json.dumps(body), "application/json"
+
+    @staticmethod
+    def result_set(rows, query):
+        columns = query.get('columns', [''])[0]
+        if columns and columns != 'DEFAULT':
+            columns = columns.split(',')
+            rows = [dict((column, row.get(column, '')) for column in columns) for row in rows]
+        body = {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+        return 200, json.dumps(body), "application/json"
+
+    @staticmethod
+    def project_row(project):
+        return {'ID': project['ID'], 'name': project['name'], 'secondary_ID': project['secondary_ID'],
+                'URI': '/data/projects/' + project['ID'], 'xsiType': 'xnat:projectData'}
+
+    @staticmethod
+    def subject_row(subject):
+        return {'ID': subject['ID'], 'label': subject['label'], 'project': subject['project'],
+                'insert_date': subject['insert_date'], 'URI': '/data/subjects/' + subject['ID'],
+                'xsiType': 'xnat:subjectData'}
+
+    def experiment_row(self, experiment):
+        data_fields = experiment['data_fields']
+        subject = self.server.store['subjects'][experiment['subject_ID']]
+        return {'ID': data_fields['ID'], 'label': data_fields['label'], 'project': data_fields['project'],
+                'subject_ID': subject['ID'], 'subject_label': subject['label'],
+                'insert_date': data_fields['insert_date'], 'last_modified': data_fields['last_modified'],
+                'URI': '/data/experiments/' + data_fields['ID'], 'xsiType': experiment['xsiType']}
+
+
+def make_server(args):
+    """
+    Function: Creates the stand-in server, call serve_forever() on it to start serving.
+    Parameters:
+        -args       ArgumentParser      Contains the size of the synthetic project and the network conditions.
+    Returns:
+        -server     StandInServer       Server bound to localhost, server.server_address holds the port.
+    """
+    return StandInServer(('localhost', args.port), generate_project(args), args)
+
+
+def parse_args(argv=None):
+    """
+    Function: Parses the command line parameters, see the top of this file.
+    Parameters:
+        -argv       List                Command line parameters, None uses sys.argv.
+    Returns:
+        -args       ArgumentParser      Contains the size of the synthetic project and the network conditions.
+    """
+    parser = argparse.ArgumentParser(description="Local XNAT REST stand-in serving a synthetic QIB project.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--project", default="Proof_Study")
+    parser.add_argument("--subjects", type=int, default=100)
+    parser.add_argument("--lateralities", default="L,R")
+    parser.add_argument("--timepoints", default="T0,T30,T78")
+    parser.add_argument("--categories", default="Cartilage,Bone")
+    parser.add_argument("--biomarkers", type=int, default=2)
+    parser.add_argument("--scanners", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--schema-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_files",
+                                                             "schemas"))
+    parser.add_argument("--qib-type", default="qib:qibSessionData")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = make_server(args)
+    print("Serving project {0} on http://localhost:{1}".format(args.project, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -16,6 +16,22 @@ Functions that are tested:
    - if no QIB is present (test_no_QIB)
    - Write meta_data (test_write_meta_data)
    - Write data (test_write_data)
+   - Base session information resolved once (test_session_info)
+   - Concept paths and ordered tag formatting (test_concept_path)
+   - Write data split per analysis tool and category (test_write_split_data)
+   - Subject x concept matrix (test_concept_matrix)
+   - QC of the biomarker values (test_quality_control)
+   - Filter configuration (test_filter)
+   - Changed subjects in daemon mode (test_daemon_changed_subjects)
+   - Daemon export after changes in XNAT (test_daemon_export_refresh)
+   - Local XNAT stand-in server (test_stand_in_server)
+   - Import from the stand-in server through xnatpy (test_stand_in_import)
+   - Columnar export (test_columnar_export)
+   - Staged export with manifest (test_export_writer)
+   - Archive streamed during the export (test_export_archive)
+   - Memory tracing per stage (test_memory_trace)
+   - Database rows (test_database_rows)
+   - Database load, only with QIB_TEST_DSN set to a test database (test_database_load)
    - write logging of subjects
         - New subject (test_write_logging_new_subject)
         - New information (test_write_logging_new_information)
@@ -23,19 +39,70 @@ Functions that are tested:
 '''
 
 import re
+import json
 import time
+import threading
+from contextlib import closing
 import shutil
 import unittest
+import numpy
+import ColumnarExport
+import ConceptPath
+import DatabaseExport
+import ExportWriter
+import MemoryTrace
+import hashlib
+import tarfile
+from types import SimpleNamespace
 import QIB2TBatch
+import QIBconverter
+import QIBdaemon
+import QualityControl
+import XNATStandIn
 from nose.tools import assert_not_equal
 import argparse
 import os
 import sys
 from ConfigStorage import ConfigStorage
+from ConceptMatrix import ConceptMatrix
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 if sys.version_info.major == 3:
     import configparser as ConfigParser
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
 elif sys.version_info.major == 2:
     import ConfigParser
+    from urllib2 import urlopen, HTTPError
+
+
+def matrix_to_dict_list(concept_matrix):
+    """
+    Function: Returns the matrix as a list with a dictionary per subject, key = header, value = value.
+    """
+    data_list = [{concept_matrix.subject_header: subject} for subject in concept_matrix.subjects]
+    for concept_id, concept_key in enumerate(concept_matrix.columns):
+        for row, number, text in concept_matrix.column_values(concept_id):
+            data_list[row][concept_key] = text
+    return data_list
+
+
+def matrix_from_dict_list(data_list, data_header_list):
+    """
+    Function: Builds a matrix from a list with a dictionary per subject, the columns in the order of data_header_list.
+    """
+    concept_matrix = ConceptMatrix()
+    concept_matrix.subject_header = data_header_list[0]
+    for header in data_header_list[1:]:
+        concept_matrix.intern(header)
+    for data_row_dict in data_list:
+        row = concept_matrix.add_row(data_row_dict.get(data_header_list[0], ''))
+        for header in data_header_list[1:]:
+            if header in data_row_dict:
+                concept_matrix.set_value(row, header, data_row_dict[header])
+    return concept_matrix
 
 
 class TestQIBDatatypeRetrieval(unittest.TestCase):
@@ -88,10 +155,14 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         args = parser.parse_args()
         args.params = self.configPath+"test.conf"
         config = ConfigStorage(args)
-        path = QIB2TBatch.create_dir(config)
-        assert os.path.exists(path)
-        assert os.path.exists(path+"/tags/")
+        path = config.base_path + config.study_id + '_dirs'
+        export = ExportWriter.ExportWriter(path)
+        assert os.path.exists(export.staging_path + "/tags/")
+        assert os.path.exists(export.staging_path + "/clinical/")
+        export.commit()
+        assert os.path.exists(path + "/tags/")
         assert os.path.exists(path + "/clinical/")
+        self.assertRaises(ValueError, ExportWriter.ExportWriter, path)
 
     def test_write_params(self):
         parser = argparse.ArgumentParser()
@@ -142,11 +213,11 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         args.all = conf_file
         config = ConfigStorage(args)
         patient_map = QIB2TBatch.get_patient_mapping(config)
-        data_list, data_header_list = QIB2TBatch.obtain_data(project, tag_file, patient_map, config)
+        concept_matrix = QIB2TBatch.obtain_data(project, tag_file, patient_map, config)
         tag_file.close()
         os.remove(tag_file.name)
-        self.assertEqual(data_header_list, header_test_list)
-        self.assertEqual(data_structure, data_list)
+        self.assertEqual(concept_matrix.header_list(), header_test_list)
+        self.assertEqual(data_structure, matrix_to_dict_list(concept_matrix))
         connection.disconnect()
 
 
@@ -162,8 +233,8 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         config = ConfigStorage(args)
         project, connection = self.setup(conf_file)
         patient_map = QIB2TBatch.get_patient_mapping(config)
-        data_list = QIB2TBatch.obtain_data(project, tagFile, patient_map, config)
-        self.assertEqual(data_list, [])
+        concept_matrix = QIB2TBatch.obtain_data(project, tagFile, patient_map, config)
+        self.assertEqual(matrix_to_dict_list(concept_matrix), [])
 
     def test_write_meta_data(self):
         tag_file = open("test.txt", "w")
@@ -173,7 +244,7 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         args.all = conf_file
         config = ConfigStorage(args)
         patient_map = QIB2TBatch.get_patient_mapping(config)
-        data_list, data_header_list = QIB2TBatch.obtain_data(project, tag_file, patient_map, config)
+        QIB2TBatch.obtain_data(project, tag_file, patient_map, config)
         tag_file.flush()
         with open("test.txt", "r") as tag_read_file:
             with open(self.file_path+ "tagstest.txt") as tag_test_file:
@@ -189,7 +260,8 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         data_header_list = ["hoi", "foo"]
         data_file = open(data_file_name, 'w')
         concept_file = open(concept_file_name, 'w')
-        QIB2TBatch.write_data(data_file, concept_file, data_list, data_header_list)
+        concept_matrix = matrix_from_dict_list(data_list, data_header_list)
+        QIB2TBatch.write_data(data_file, concept_file, concept_matrix)
 
         with open(data_file_name, 'r') as data_final_file:
             with open(self.file_path+ "datatest.txt") as data_test_file:
@@ -203,6 +275,512 @@ class TestQIBDatatypeRetrieval(unittest.TestCase):
         os.remove(data_file.name)
         os.remove(concept_file.name)
 
+    def test_session_info(self):
+        class Sessions(dict):
+            walks = 0
+
+            def values(self):
+                Sessions.walks += 1
+                return dict.values(self)
+
+        session = SimpleNamespace(base_sessions=Sessions(b=SimpleNamespace(accession_identifier="PROOF001_MRI")))
+        image_session = SimpleNamespace(get={'scanner/model': "Skyra", 'scanner/manufacturer': "Siemens"}.get)
+        project = SimpleNamespace(experiments={"PROOF001_MRI": SimpleNamespace(_fields={'laterality': "R"}),
+                                               "PROOF001_MRI_L_T0": image_session})
+        config = SimpleNamespace(filter_lateralities=None, filter_timepoints=None)
+        session_info, scanner_dict = QIB2TBatch.get_session_data("QIB_PROOF001_MRI_L_T0".split('_'), project, session,
+                                                                 {"SiemensSkyra": 3}, config)
+        self.assertEqual(session_info, QIB2TBatch.SessionInfo("R", "T0", ("PROOF001_MRI",), "scanner3", "Skyra",
+                                                              "Siemens"))
+        concepts = [(concept_key, "volume", "http://example.org/volume")
+                    for concept_key in ["tool\\volume", "tool\\thickness"]]
+        tag_lines = ConceptPath.format_concept_tags(concepts, session_info).splitlines()
+        self.assertEqual(Sessions.walks, 1)
+        self.assertEqual(tag_lines[:3], ["tool\\volume\tOntology name\tvolume\t1",
+                                              "tool\\volume\tOntology IRI\thttp://example.org/volume\t1",
+                                              "tool\\volume\taccession identifier\tPROOF001_MRI\t2"])
+        self.assertEqual(tag_lines[3:8], ["tool\\volume\tlaterality\tR\t2", "tool\\volume\ttimepoint\tT0\t2",
+                                               "tool\\volume\tscanner model\tSkyra\t2",
+                                               "tool\\volume\tscanner manufacturer\tSiemens\t2",
+                                               "tool\\volume\tscanner\tscanner3\t2"])
+        self.assertEqual(len(tag_lines), 16)
+
+    def test_concept_path(self):
+        concept_paths = ConceptPath.ConceptPathBuilder()
+        self.assertEqual(concept_paths.concept_key("tool 0.1", "scanner1", "Cartilage", "L", "T0", 12),
+                         "tool 0.1\\scanner1\\Cartilage\\L\\T0\\12")
+        self.assertEqual(concept_paths.concept_key("tool 0.1", "scanner1", "Cartilage", "L", "T0", "volume"),
+                         "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume")
+        self.assertEqual(len(concept_paths.prefixes), 1)
+
+        session_info = QIB2TBatch.SessionInfo("L", "T0", ("PROOF001_MRI",), "scanner1", "Skyra", "Siemens")
+        expected = []
+        for workers in [0, 2]:
+            tag_file = ColumnarExport.TagRecorder(open("test.txt", "w"))
+            tag_writer = ConceptPath.OrderedTagWriter(tag_file, workers)
+            for batch in range(20):
+                tag_writer.write("tool\tdescription\t" + str(batch) + "\t1\n")
+                tag_writer.write_concept_tags([("tool\\" + str(batch) + "\\" + str(i), "name", "iri")
+                                               for i in range(50)], session_info)
+            tag_writer.close()
+            tag_file.close()
+            os.remove(tag_file.name)
+            expected = expected or tag_file.lines
+            self.assertEqual(tag_file.lines, expected)
+        self.assertEqual(len(expected), 20 * (1 + 50 * 8))
+        self.assertEqual(expected[1], "tool\\0\\0\tOntology name\tname\t1")
+
+    def test_concept_matrix(self):
+        concept_matrix = ConceptMatrix()
+        row1 = concept_matrix.add_row("subject1")
+        self.assertTrue(concept_matrix.set_value(row1, "tool\\volume", "6980.625"))
+        row2 = concept_matrix.add_row("subject2")
+        self.assertFalse(concept_matrix.set_value(row2, "tool\\volume", "foo"))
+        concept_matrix.set_value(row2, "tool\\area", "11")
+        numbers, missing = concept_matrix.numeric_matrix()
+        self.assertEqual(concept_matrix.header_list(), ["subject", "tool\\volume", "tool\\area"])
+        self.assertEqual(numbers[0, 0], 6980.625)
+        assert numbers[1, 0] != numbers[1, 0]
+        self.assertEqual(missing.tolist(), [[False, True], [False, False]])
+        self.assertEqual(list(concept_matrix.rows()), [["subject1\t", "6980.625\t", "\n"],
+                                                       ["subject2\t", "foo\t", "11\n"]])
+        # Columns only store the rows with a value, the text is kept where the float does not reproduce it.
+        row3 = concept_matrix.add_row("subject3")
+        concept_matrix.set_value(row3, "tool\\area", "1.50")
+        concept_matrix.set_value(row1, "tool\\area", "1e2")
+        concept_matrix.set_value(row2, "tool\\volume", "")
+        row_ids, column_numbers = concept_matrix.sparse_column(1)
+        self.assertEqual(row_ids.tolist(), [0, 1, 2])
+        self.assertEqual(column_numbers.tolist(), [100.0, 11.0, 1.5])
+        self.assertEqual(concept_matrix.value(1, row1), "1e2")
+        self.assertEqual(concept_matrix.value(0, row2), None)
+        self.assertEqual(concept_matrix.present_rows([0]), {0})
+        self.assertEqual(list(concept_matrix.rows(row_ids=[1, 2])), [["subject2\t", "\t", "11\n"],
+                                                                    ["subject3\t", "\t", "1.50\n"]])
+
+    def test_quality_control(self):
+        concept_matrix = ConceptMatrix()
+        values = [("S1", "8758.3", "9198.0"), ("S2", "7943.4", "25.2"), ("S3", "8248.5", "9208.5"),
+                  ("S4", "8100.1", "9150.3"), ("S5", "8430.9", None), ("S6", "n/a", "9100.0")]
+        for subject, value_t0, value_t30 in values:
+            row = concept_matrix.add_row(subject)
+            concept_matrix.set_value(row, "tool\\MRI\\Cartilage\\L\\T0\\volume", value_t0)
+            if value_t30 is not None:
+                concept_matrix.set_value(row, "tool\\MRI\\Cartilage\\L\\T30\\volume", value_t30)
+        numbers, missing = concept_matrix.numeric_matrix()
+        statistics, outliers, non_numeric = QualityControl.concept_statistics(numbers, missing, 1.5)
+        self.assertEqual(statistics['values'].tolist(), [5, 5])
+        self.assertEqual(statistics['non_numeric'].tolist(), [1, 0])
+        self.assertEqual(numpy.flatnonzero(outliers[:, 1]).tolist(), [1])
+        self.assertEqual(numpy.flatnonzero(non_numeric[:, 0]).tolist(), [5])
+        gaps = QualityControl.missing_timepoints(concept_matrix)
+        self.assertEqual(gaps, [("tool\\*\\Cartilage\\L\\*\\volume", 4, "T30")])
+        # The timepoints of one subject can have been acquired on different scanners.
+        scanner_matrix = ConceptMatrix()
+        row = scanner_matrix.add_row("S1")
+        scanner_matrix.set_value(row, "tool\\scanner1\\Cartilage\\L\\T0\\volume", "8758.3")
+        scanner_matrix.set_value(row, "tool\\scanner2\\Cartilage\\L\\T30\\volume", "9198.0")
+        row = scanner_matrix.add_row("S2")
+        scanner_matrix.set_value(row, "tool\\scanner1\\Cartilage\\L\\T0\\volume", "7943.4")
+        scanner_matrix.set_value(row, "tool\\scanner1\\Cartilage\\L\\T30\\volume", "8100.1")
+        row = scanner_matrix.add_row("S3")
+        scanner_matrix.set_value(row, "tool\\scanner2\\Cartilage\\L\\T0\\volume", "8248.5")
+        self.assertEqual(QualityControl.missing_timepoints(scanner_matrix),
+                         [("tool\\*\\Cartilage\\L\\*\\volume", 2, "T30")])
+        path = "qc_test"
+        os.makedirs(path, exist_ok=True)
+        try:
+            config = argparse.Namespace(qc_outlier_factor=1.5)
+            self.assertEqual(QualityControl.write_qc_report(concept_matrix, path, config), 3)
+            with open(path + "/QC_report.txt") as report_file:
+                flag_lines = report_file.read().split("\n\n")[1].splitlines()[1:]
+            self.assertEqual(flag_lines, ["Outlier\ttool\\MRI\\Cartilage\\L\\T30\\volume\tS2\t25.2",
+                                          "Non-numeric\ttool\\MRI\\Cartilage\\L\\T0\\volume\tS6\tn/a",
+                                          "Missing timepoint\ttool\\*\\Cartilage\\L\\*\\volume\tS5\tT30"])
+        finally:
+            shutil.rmtree(path)
+
+    def test_filter(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--tags")
+        args = parser.parse_args()
+        args.tags = self.configPath+"filter.conf"
+        config = ConfigStorage(args)
+        self.assertEqual(config.filter_categories, {"Cartilage"})
+        self.assertEqual(config.filter_biomarkers, None)
+        assert QIB2TBatch.is_selected("Femur volume", config.filter_biomarkers)
+        assert not QIB2TBatch.is_selected("Bone", config.filter_categories)
+        # The timepoint of the base session takes precedence over the label, so a label with an excluded timepoint
+        # can still be selected. An excluded experiment does not add its scanner to the scanner file.
+        session = SimpleNamespace(base_sessions={'b': SimpleNamespace(accession_identifier="PROOF001_MRI")})
+        project = SimpleNamespace(experiments={"PROOF001_MRI": SimpleNamespace(_fields={'timepoint': "T78"}),
+                                               "PROOF001_MRI_L_T78": SimpleNamespace(get={}.get)})
+        config.scanner_dict_file = "filter_scanners.txt"
+        self.empty_file(config.scanner_dict_file)
+        try:
+            self.assertEqual(QIB2TBatch.get_session_data("QIB_PROOF001_MRI_L_T0".split('_'), project, session, {},
+                                                         config), (None, {}))
+            project.experiments["PROOF001_MRI"]._fields['timepoint'] = "T0"
+            session_info, scanner_dict = QIB2TBatch.get_session_data("QIB_PROOF001_MRI_L_T78".split('_'), project,
+                                                                     session, {}, config)
+            self.assertEqual((session_info.laterality, session_info.timepoint), ("L", "T0"))
+            with open(config.scanner_dict_file) as scanner_file:
+                self.assertEqual(scanner_file.read(), "Not specifiedNot specified\t1\n")
+        finally:
+            os.remove(config.scanner_dict_file)
+
+    def test_daemon_changed_subjects(self):
+        known_experiments = {"QIB_PROOF001_MRI_L_T0": "2017-08-03 10:00:00.0",
+                             "QIB_PROOF002_MRI_L_T0": "2017-08-03 10:00:00.0"}
+        experiments = {"QIB_PROOF001_MRI_L_T0": ("PROOF001", "2017-08-03 10:00:00.0"),
+                       "QIB_PROOF002_MRI_L_T0": ("PROOF002", "2017-08-04 12:00:00.0"),
+                       "QIB_PROOF003_MRI_R_T0": ("PROOF003", "2017-08-04 12:00:00.0")}
+        self.assertEqual(QIBdaemon.changed_subjects(experiments, known_experiments), {"PROOF002", "PROOF003"})
+
+    def test_daemon_export_refresh(self):
+        class Session(object):
+            def __init__(self, label, value):
+                biomarker = SimpleNamespace(id="volume", value=value, ontology_name="volume", ontology_iri="iri")
+                category = SimpleNamespace(category_name="Cartilage", biomarkers={'b1': biomarker})
+                self.label = "QIB_" + label
+                self.project = "Proof_Study"
+                self.analysis_tool = "tool"
+                self.analysis_tool_version = "0.1"
+                self.biomarker_categories = {'c1': category}
+                self.base_sessions = {'b': SimpleNamespace(accession_identifier=label)}
+
+        class CachingProject(object):
+            # Like xnatpy, the listings are read once and kept until clearcache is called.
+            def __init__(self, server):
+                self.server = server
+                self.cache = None
+                self.xnat_session = SimpleNamespace(clearcache=self.clearcache)
+
+            def clearcache(self):
+                self.cache = None
+
+            def listing(self):
+                if self.cache is None:
+                    subjects = {}
+                    experiments = {}
+                    for subject_label, value in self.server.items():
+                        label = subject_label + "_MRI_L_T0"
+                        session = Session(label, value)
+                        subjects[subject_label] = SimpleNamespace(label=subject_label,
+                                                                  experiments={session.label: session})
+                        experiments[label] = SimpleNamespace(_fields={}, get={}.get)
+                    self.cache = subjects, experiments
+                return self.cache
+
+            @property
+            def subjects(self):
+                return self.listing()[0]
+
+            @property
+            def experiments(self):
+                return self.listing()[1]
+
+        path = "daemon_test/"
+        os.makedirs(path, exist_ok=True)
+        scanner_file = path + "scanners.txt"
+        open(scanner_file, "w").close()
+        config = argparse.Namespace(study_id="QIBTEST", security_req="N", top_node="\\Public Studies\\QIBTEST\\",
+                                    append_facts="N", base_path=path, project_name="Proof_Study",
+                                    scanner_dict_file=scanner_file, tag_list=[], filter_categories=None,
+                                    filter_biomarkers=None, filter_lateralities=None, filter_timepoints=None,
+                                    split_clinical=False, columnar=False, database=False, format_workers=0,
+                                    export_buffer_size=4096, export_archive=False, qc=True, qc_outlier_factor=1.5)
+        server = {"PROOF001": "10"}
+        project = CachingProject(server)
+        try:
+            QIBdaemon.export_subjects(project, config, {}, ["PROOF001"])
+            server["PROOF001"] = "20"
+            server["PROOF002"] = "30"
+            time.sleep(1)
+            export_path = QIBdaemon.export_subjects(project, config, {}, ["PROOF001", "PROOF002", "PROOF003"])
+            with open(export_path + "/clinical/QIBTEST_clinical.txt") as data_file:
+                rows = data_file.readlines()[1:]
+            self.assertEqual(rows, ["PROOF001\t20\n", "PROOF002\t30\n"])
+            with open(export_path + "/study.params") as study_params:
+                self.assertIn("APPEND_FACTS=Y", study_params.read().split("\n"))
+            assert os.path.exists(export_path + "/QC_report.txt")
+        finally:
+            shutil.rmtree(path)
+
+    def test_stand_in_server(self):
+        args = XNATStandIn.parse_args(["--port", "0", "--subjects", "2", "--timepoints", "T0,T78", "--seed", "1"])
+        server = XNATStandIn.make_server(args)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        url = "http://localhost:" + str(server.server_address[1])
+        try:
+            with closing(urlopen(url + "/data/projects/Proof_Study/experiments?format=json")) as response:
+                experiments = json.loads(response.read().decode('utf-8'))['ResultSet']['Result']
+            self.assertEqual(len(experiments), 16)
+            qib_uri = [x['URI'] for x in experiments if x['label'] == "QIB_SUBJ00002_MRI_R_T78"][0]
+            with closing(urlopen(url + qib_uri + "?format=json")) as response:
+                qib = json.loads(response.read().decode('utf-8'))['items'][0]
+            self.assertEqual(qib['data_fields']['project'], "Proof_Study")
+            base_session_id = qib['children'][1]['items'][0]['data_fields']['accession_identifier']
+            with closing(urlopen(url + "/data/experiments/" + base_session_id + "?format=json")) as response:
+                base_session = json.loads(response.read().decode('utf-8'))['items'][0]
+            self.assertEqual(base_session['children'][0]['items'][1]['data_fields'], {'name': 'timepoint',
+                                                                                       'field': 'T78'})
+            server.args.error_rate = 1.0
+            with self.assertRaises(HTTPError):
+                urlopen(url + "/data/version")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_stand_in_import(self):
+        # test_files/schemas holds only the part of the XNAT and QIB schemas that the importer reads.
+        args = XNATStandIn.parse_args(["--port", "0", "--subjects", "2", "--timepoints", "T0,T78", "--scanners", "1",
+                                       "--seed", "1", "--schema-dir", self.file_path + "schemas"])
+        server = XNATStandIn.make_server(args)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.empty_file("stand_in_scanners.txt")
+        config = argparse.Namespace(connection_name="http://localhost:" + str(server.server_address[1]), user="test",
+                                    pssw="test", project_name="Proof_Study", scanner_dict_file="stand_in_scanners.txt",
+                                    tag_list=["analysis_tool", "description"], filter_categories=None,
+                                    filter_biomarkers=None, filter_lateralities=None, filter_timepoints=None,
+                                    format_workers=0)
+        tag_file = ColumnarExport.TagRecorder(open(os.devnull, 'w'))
+        try:
+            project, connection = QIB2TBatch.make_connection(config)
+            concept_matrix = QIB2TBatch.obtain_data(project, tag_file, {}, config)
+            connection.disconnect()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            tag_file.close()
+            os.remove("stand_in_scanners.txt")
+        self.assertEqual(concept_matrix.subjects, ["SUBJ00001", "SUBJ00002"])
+        # 2 lateralities x 2 timepoints x 2 categories x 2 biomarkers, all on the one scanner.
+        self.assertEqual(len(concept_matrix.columns), 16)
+        self.assertEqual(concept_matrix.columns[0],
+                         "StandIn Segmentation 0.1\\scanner1\\Cartilage\\L\\T0\\Cartilage biomarker 1 (mm^3)")
+        self.assertEqual(concept_matrix.present_rows(range(16)), {0, 1})
+        self.assertIn("StandIn Segmentation 0.1\tanalysis tool\tStandIn Segmentation\t2", tag_file.lines)
+
+    def test_write_split_data(self):
+        path = "split_test"
+        os.makedirs(path + "/clinical/", exist_ok=True)
+        concept_matrix = ConceptMatrix()
+        row = concept_matrix.add_row("subject1")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "6980.625")
+        concept_matrix.set_value(row, "tool 0.1\\scanner2\\Cartilage\\L\\T78\\volume", "7012.5")
+        row = concept_matrix.add_row("subject2")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Bone\\L\\T0\\volume", "10980.625")
+        self.assertEqual(QIB2TBatch.split_columns(concept_matrix), [("tool 0.1 Cartilage", [0, 1]),
+                                                                    ("tool 0.1 Bone", [2])])
+        config = argparse.Namespace(study_id="QIBTEST")
+        subject_logger = QIB2TBatch.set_subject_logger(True, path, None)
+        self.empty_file(subject_logger.handlers[0].baseFilename)
+        try:
+            with open(path + "/clinical/columns.txt", "w") as concept_file:
+                QIB2TBatch.write_split_data(path, concept_file, concept_matrix, config)
+            with open(path + "/clinical/QIBTEST_tool_0_1_Bone_clinical.txt") as data_file:
+                self.assertEqual(data_file.read(), "subject\ttool 0.1\\scanner1\\Bone\\L\\T0\\volume\n"
+                                                   "subject2\t10980.625\n")
+            with open(path + "/clinical/columns.txt") as concept_file:
+                self.assertEqual(concept_file.readlines()[3], "QIBTEST_tool_0_1_Bone_clinical.txt\tsubject\t1\tSUBJ_ID\n")
+        finally:
+            for handler in list(subject_logger.handlers):
+                subject_logger.removeHandler(handler)
+                handler.close()
+            shutil.rmtree(path)
+
+    @unittest.skipUnless(pyarrow, "pyarrow not installed")
+    def test_columnar_export(self):
+        concept_matrix = ConceptMatrix()
+        row = concept_matrix.add_row("subject1")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "6980.625")
+        row = concept_matrix.add_row("subject2")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "n/a")
+        table = ColumnarExport.observation_table(pyarrow, concept_matrix)
+        self.assertEqual(table.to_pylist()[0], {'subject': "subject1", 'tool': "tool 0.1", 'scanner': "scanner1",
+                                                'category': "Cartilage", 'laterality': "L", 'timepoint': "T0",
+                                                'biomarker': "volume", 'value': 6980.625, 'raw_value': "6980.625"})
+        self.assertEqual(table.column('value').to_pylist(), [6980.625, None])
+        tag_file = ColumnarExport.TagRecorder(open("test.txt", "w"))
+        tag_file.write("tool 0.1\tanalysis tool\ttool\t2\ntool 0.1\tdescription\tfoo\t1\n")
+        tag_file.close()
+        os.remove(tag_file.name)
+        self.assertEqual(ColumnarExport.tag_table(pyarrow, tag_file.lines).column('weight').to_pylist(), [2, 1])
+
+    def test_export_writer(self):
+        path = "export_test"
+        config = argparse.Namespace(study_id="QIBTEST", security_req="N", top_node="\\Public Studies\\QIBTEST\\",
+                                    append_facts="N", split_clinical=False)
+        export = ExportWriter.ExportWriter(path)
+        try:
+            QIB2TBatch.write_params(export.staging_path, config, export)
+            tag_file, data_file, concept_file = QIB2TBatch.write_headers(export.staging_path, config, export)
+            tag_file.write("tool 0.1\tanalysis tool\ttool\t2\n")
+            with open(export.staging_path + "/QC_report.txt", "w") as report_file:
+                report_file.write("report\n")
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual(export.commit(), path)
+            self.assertFalse(os.path.exists(export.staging_path))
+            with open(path + "/" + ExportWriter.MANIFEST_NAME) as manifest_file:
+                manifest = json.load(manifest_file)['files']
+            self.assertEqual(sorted(manifest), ["QC_report.txt", "clinical/QIBTEST_clinical.txt",
+                                                "clinical/QIBTEST_columns.txt", "clinical/clinical.params",
+                                                "study.params", "tags/tags.params", "tags/tags.txt"])
+            with open(path + "/tags/tags.txt", "rb") as read_file:
+                data = read_file.read()
+            self.assertEqual(manifest["tags/tags.txt"], {'lines': 2, 'bytes': len(data),
+                                                         'sha256': hashlib.sha256(data).hexdigest()})
+            self.assertEqual(manifest["QC_report.txt"]['lines'], 1)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        export = ExportWriter.ExportWriter(path)
+        export.open("tags/tags.txt").write("foo\n")
+        export.abort()
+        self.assertFalse(os.path.exists(export.staging_path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_export_archive(self):
+        path = "archive_test"
+        export = ExportWriter.ExportWriter(path, archive=True)
+        try:
+            tag_file = export.open("tags/tags.txt")
+            data_file = export.open("clinical/QIBTEST_clinical.txt")
+            tag_file.write("Concept Path\tTitle\tDescription\tWeight\n")
+            data_file.write("subject\tvolume\nsubject1\t6980.625\n")
+            tag_file.write("tool 0.1\tanalysis tool\ttool\t2\n")
+            data_file.close()
+            with open(export.staging_path + "/QC_report.txt", "w") as report_file:
+                report_file.write("report\n")
+            export.commit()
+            with tarfile.open(path + ExportWriter.ARCHIVE_EXTENSION) as archive:
+                self.assertEqual(archive.getnames(), [path + "/clinical/QIBTEST_clinical.txt",
+                                                      path + "/tags/tags.txt", path + "/QC_report.txt",
+                                                      path + "/" + ExportWriter.MANIFEST_NAME])
+                for name in archive.getnames():
+                    with open(name, "rb") as export_file:
+                        self.assertEqual(archive.extractfile(name).read(), export_file.read())
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            if os.path.exists(path + ExportWriter.ARCHIVE_EXTENSION):
+                os.remove(path + ExportWriter.ARCHIVE_EXTENSION)
+
+        export = ExportWriter.ExportWriter(path, archive=True)
+        export.open("tags/tags.txt").write("foo\n")
+        export.abort()
+        self.assertFalse(os.path.exists(path + ExportWriter.ARCHIVE_EXTENSION + ExportWriter.STAGING_SUFFIX))
+
+    def test_memory_trace(self):
+        tracer = MemoryTrace.MemoryTracer({'allocate': 1, 'total': 100}, top=5)
+        tracer.start()
+        try:
+            with tracer.stage('allocate'):
+                retained = [str(i) * 10 for i in range(100000)]
+            with tracer.stage('free'):
+                del retained
+        finally:
+            tracer.stop()
+        allocate, free = tracer.stages
+        self.assertGreater(allocate['peak'], MemoryTrace.MB)
+        self.assertGreater(allocate['retained'], MemoryTrace.MB)
+        self.assertLess(free['retained'], 0)
+        self.assertTrue(allocate['sites'])
+        self.assertLessEqual(len(allocate['sites']), 5)
+        self.assertEqual(len(tracer.exceeded()), 1)
+        self.assertRaises(MemoryTrace.MemoryBudgetError, tracer.check)
+        tracer.write_report("memory_test.txt")
+        with open("memory_test.txt") as report_file:
+            lines = report_file.readlines()
+        os.remove("memory_test.txt")
+        self.assertEqual(lines[0], "\t".join(MemoryTrace.REPORT_HEADERS) + "\n")
+        self.assertTrue(lines[1].startswith("allocate\t"))
+        self.assertTrue(lines[1].endswith("\t1\n"))
+
+        tracer = MemoryTrace.MemoryTracer(enabled=False)
+        with tracer.stage('allocate'):
+            pass
+        self.assertEqual(tracer.stages, [])
+        tracer.check()
+        # The daemon never finishes a traced run, so the combination is refused before connecting.
+        self.assertRaises(SystemExit, QIBconverter.main, argparse.Namespace(daemon=True, trace_memory=True))
+
+    def database_config(self):
+        return argparse.Namespace(study_id="QIBTEST", top_node="\\Public Studies\\QIBTEST\\",
+                                  database_dsn=os.environ.get("QIB_TEST_DSN"), database_schema="qibtest",
+                                  database_metadata_schema="qibtest_metadata", database_batch_size=2,
+                                  database_create_tables=True)
+
+    def database_matrix(self):
+        concept_matrix = ConceptMatrix()
+        row = concept_matrix.add_row("subject1")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "6980.625")
+        row = concept_matrix.add_row("subject2")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "n/a")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\thickness", "2.5")
+        return concept_matrix
+
+    def test_database_rows(self):
+        config = self.database_config()
+        concept_matrix = self.database_matrix()
+        concept_key = "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume"
+        concept_cd = DatabaseExport.concept_code(config, concept_key)
+        self.assertEqual(DatabaseExport.concept_path(config, concept_key),
+                         "\\Public Studies\\QIBTEST\\" + concept_key + "\\")
+        self.assertEqual(list(DatabaseExport.concept_rows(concept_matrix, config))[0],
+                         (concept_cd, "\\Public Studies\\QIBTEST\\" + concept_key + "\\", "volume", "QIBTEST"))
+        facts = list(DatabaseExport.fact_rows(concept_matrix, {"subject1": 1, "subject2": 2}, config, "2017-01-01"))
+        self.assertEqual(len(facts), 3)
+        self.assertEqual(facts[0], (1, 1, concept_cd, '@', "2017-01-01", '@', 1, 'N', 'E', "6980.625", "QIBTEST"))
+        self.assertEqual(facts[1], (2, 2, concept_cd, '@', "2017-01-01", '@', 1, 'T', "n/a", None, "QIBTEST"))
+        # Values that do not fit nval_num numeric(18,5) are loaded as text instead of aborting the load.
+        concept_matrix = ConceptMatrix()
+        for value in ["inf", "-Infinity", "1e13", "-12345678901234.5", "9999999999999.99"]:
+            concept_matrix.set_value(concept_matrix.add_row(value), concept_key, value)
+        facts = list(DatabaseExport.fact_rows(concept_matrix, dict((value, 1) for value in concept_matrix.subjects),
+                                              config, "2017-01-01"))
+        self.assertEqual([fact[7:10] for fact in facts], [('T', "inf", None), ('T', "-Infinity", None),
+                                                          ('T', "1e13", None), ('T', "-12345678901234.5", None),
+                                                          ('N', 'E', "9999999999999.99")])
+        tags = list(DatabaseExport.tag_rows(["tool 0.1\tanalysis tool\ttool\t2", ""], config))
+        self.assertEqual(tags, [("\\Public Studies\\QIBTEST\\tool 0.1\\", "tool", "analysis tool", 2)])
+
+    @unittest.skipUnless(os.environ.get("QIB_TEST_DSN"), "QIB_TEST_DSN not set")
+    def test_database_load(self):
+        import psycopg2
+        config = self.database_config()
+        tag_lines = ["tool 0.1\tanalysis tool\ttool\t2"]
+        DatabaseExport.write_database(self.database_matrix(), tag_lines, config)
+        # A second load replaces the study instead of adding to it.
+        counts = DatabaseExport.write_database(self.database_matrix(), tag_lines, config)
+        self.assertEqual(counts, {'patient_dimension': 0, 'concept_dimension': 2, 'observation_fact': 3,
+                                  'i2b2_tags': 1})
+        # Infinite values and values that do not fit numeric(18,5) must not abort the load.
+        concept_matrix = self.database_matrix()
+        row = concept_matrix.add_row("subject3")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\volume", "inf")
+        concept_matrix.set_value(row, "tool 0.1\\scanner1\\Cartilage\\L\\T0\\thickness", "9999999999999.99")
+        counts = DatabaseExport.write_database(concept_matrix, tag_lines, config)
+        self.assertEqual(counts['observation_fact'], 5)
+        connection = psycopg2.connect(config.database_dsn)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM qibtest.observation_fact WHERE sourcesystem_cd = 'QIBTEST'")
+                self.assertEqual(cursor.fetchone()[0], 5)
+                cursor.execute("SELECT tval_char, nval_num FROM qibtest.observation_fact WHERE valtype_cd = 'T' "
+                               "ORDER BY tval_char")
+                self.assertEqual(cursor.fetchall(), [("inf", None), ("n/a", None)])
+                cursor.execute("SELECT max(nval_num) FROM qibtest.observation_fact WHERE valtype_cd = 'N'")
+                self.assertEqual(str(cursor.fetchone()[0]), "9999999999999.99000")
+                cursor.execute("DROP SCHEMA qibtest, qibtest_metadata CASCADE")
+            connection.commit()
+        finally:
+            connection.close()
+
     def test_write_logging_new_subject(self):
         rows = [["subject1\t","foo\n"], ["subject2\t", "bar\n"]]
         test_log = ["subject1\tfoo\n","subject2\tbar\n"]